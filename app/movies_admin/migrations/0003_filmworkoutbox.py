@@ -0,0 +1,106 @@
+from django.db import migrations, models
+
+OUTBOX_TRIGGERS_SQL = """
+ALTER TABLE content.film_work_outbox ALTER COLUMN created SET DEFAULT now();
+
+CREATE OR REPLACE FUNCTION content.outbox_film_work() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id) VALUES (NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION content.outbox_film_work_link()
+RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO content.film_work_outbox (film_work_id)
+        VALUES (OLD.film_work_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE'
+            AND NEW.film_work_id IS DISTINCT FROM OLD.film_work_id) THEN
+        INSERT INTO content.film_work_outbox (film_work_id)
+        VALUES (NEW.film_work_id);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION content.outbox_person() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    SELECT film_work_id FROM content.person_film_work
+    WHERE person_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION content.outbox_genre() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO content.film_work_outbox (film_work_id)
+    SELECT film_work_id FROM content.genre_film_work
+    WHERE genre_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER film_work_outbox
+AFTER INSERT OR UPDATE ON content.film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work();
+
+CREATE TRIGGER person_film_work_outbox
+AFTER INSERT OR UPDATE OR DELETE ON content.person_film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work_link();
+
+CREATE TRIGGER genre_film_work_outbox
+AFTER INSERT OR UPDATE OR DELETE ON content.genre_film_work
+FOR EACH ROW EXECUTE FUNCTION content.outbox_film_work_link();
+
+-- в документ фильма попадают только имена персон и жанров
+CREATE TRIGGER person_outbox
+AFTER UPDATE ON content.person
+FOR EACH ROW WHEN (OLD.full_name IS DISTINCT FROM NEW.full_name)
+EXECUTE FUNCTION content.outbox_person();
+
+CREATE TRIGGER genre_outbox
+AFTER UPDATE ON content.genre
+FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+EXECUTE FUNCTION content.outbox_genre();
+"""
+
+DROP_OUTBOX_TRIGGERS_SQL = """
+DROP TRIGGER IF EXISTS film_work_outbox ON content.film_work;
+DROP TRIGGER IF EXISTS person_film_work_outbox ON content.person_film_work;
+DROP TRIGGER IF EXISTS genre_film_work_outbox ON content.genre_film_work;
+DROP TRIGGER IF EXISTS person_outbox ON content.person;
+DROP TRIGGER IF EXISTS genre_outbox ON content.genre;
+DROP FUNCTION IF EXISTS content.outbox_film_work();
+DROP FUNCTION IF EXISTS content.outbox_film_work_link();
+DROP FUNCTION IF EXISTS content.outbox_person();
+DROP FUNCTION IF EXISTS content.outbox_genre();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies_admin', '0002_auto_20230709_1356'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FilmworkOutbox',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('film_work_id', models.UUIDField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'content"."film_work_outbox',
+            },
+        ),
+        migrations.RunSQL(
+            sql=OUTBOX_TRIGGERS_SQL,
+            reverse_sql=DROP_OUTBOX_TRIGGERS_SQL,
+        ),
+    ]
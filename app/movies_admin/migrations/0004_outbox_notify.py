@@ -0,0 +1,35 @@
+from django.db import migrations
+
+# Уведомление на оператор, а не на строку: NOTIFY доставляется при commit,
+# одинаковые уведомления транзакции postgres склеивает в одно.
+OUTBOX_NOTIFY_SQL = """
+CREATE OR REPLACE FUNCTION content.outbox_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('film_work_outbox', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER film_work_outbox_notify
+AFTER INSERT ON content.film_work_outbox
+FOR EACH STATEMENT EXECUTE FUNCTION content.outbox_notify();
+"""
+
+DROP_OUTBOX_NOTIFY_SQL = """
+DROP TRIGGER IF EXISTS film_work_outbox_notify ON content.film_work_outbox;
+DROP FUNCTION IF EXISTS content.outbox_notify();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('movies_admin', '0003_filmworkoutbox'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=OUTBOX_NOTIFY_SQL,
+            reverse_sql=DROP_OUTBOX_NOTIFY_SQL,
+        ),
+    ]
@@ -0,0 +1,34 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY не работает внутри транзакции,
+    # зато не блокирует запись в таблицы, пока индекс строится
+    atomic = False
+
+    dependencies = [
+        ('movies_admin', '0004_outbox_notify'),
+    ]
+
+    operations = [
+        # страницы продюсера ETL: WHERE (modified, id) > курсор
+        # ORDER BY modified, id LIMIT n
+        AddIndexConcurrently(
+            model_name='filmwork',
+            index=models.Index(fields=['modified', 'id'],
+                               name='film_work_modified_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='genre',
+            index=models.Index(fields=['modified', 'id'],
+                               name='genre_modified_id_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='person',
+            index=models.Index(fields=['modified', 'id'],
+                               name='person_modified_id_idx'),
+        ),
+        # связи страниц энричера ищутся по индексам внешних ключей
+        # person_id и genre_id из 0001, своих индексов им не нужно
+    ]
@@ -35,6 +35,10 @@ class Genre(UUIDMixin, TimeStampedMixin):
         # Следующие два поля отвечают за название модели в интерфейсе
         verbose_name = _('genre')
         verbose_name_plural = _('genres')
+        indexes = [
+            models.Index(fields=['modified', 'id'],
+                         name='genre_modified_id_idx'),
+        ]
 
 
 class Person(UUIDMixin, TimeStampedMixin):
@@ -45,6 +49,10 @@ class Person(UUIDMixin, TimeStampedMixin):
 
     class Meta:
         db_table = "content\".\"person"
+        indexes = [
+            models.Index(fields=['modified', 'id'],
+                         name='person_modified_id_idx'),
+        ]
 
 
 class Filmwork(UUIDMixin, TimeStampedMixin):
@@ -78,6 +86,8 @@ class Filmwork(UUIDMixin, TimeStampedMixin):
         indexes = [
             models.Index(fields=['creation_date'],
                          name='film_work_creation_date_idx'),
+            models.Index(fields=['modified', 'id'],
+                         name='film_work_modified_id_idx'),
         ]
 
 
@@ -117,3 +127,18 @@ class PersonFilmwork(UUIDMixin):
                 fields=['film_work_id', 'person_id', 'role'],
                 name='film_work_person'),
         ]
+
+
+class FilmworkOutbox(models.Model):
+    """Очередь изменённых кинопроизведений для ETL.
+
+    Заполняется триггерами на таблицах content (миграция 0003),
+    ETL разбирает её пачками и удаляет обработанные строки.
+    """
+    id = models.BigAutoField(primary_key=True)
+    # не ForeignKey: строка должна пережить изменения самого фильма
+    film_work_id = models.UUIDField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = "content\".\"film_work_outbox"
@@ -0,0 +1,165 @@
+"""Планы запросов ETL на сгенерированных данных.
+
+Каталог генерируется в транзакции и откатывается после тестов,
+таблицы content.* и индексы создают миграции movies_admin:
+(modified, id) для продюсера - 0005, внешние ключи связей - 0001.
+Запросы берутся из etl/queries.py - те же, что выполняет ETL.
+"""
+
+import hashlib
+import os
+import sys
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+import psycopg2
+import pytest
+from dotenv import load_dotenv
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3] / 'etl'))
+queries = pytest.importorskip('queries')
+
+load_dotenv()
+
+dsl = {
+    'dbname': os.environ.get('DB_NAME'),
+    'user': os.environ.get('DB_USER'),
+    'password': os.environ.get('DB_PASSWORD'),
+    'host': os.environ.get('DB_HOST', '127.0.0.1'),
+    'port': os.environ.get('DB_PORT', 5432),
+}
+
+SIZES = {
+    'films': 20000,
+    'persons': 5000,
+    'genres': 1000,
+    'cast': 5,
+    'genres_per_film': 2,
+}
+LIMIT_SIZE = 100  # MAIN_LIMIT_SIZE по умолчанию
+START = (datetime(1970, 1, 1, tzinfo=timezone.utc), str(uuid.UUID(int=0)))
+INDEX_SCANS = frozenset(('Index Scan', 'Index Only Scan', 'Bitmap Index Scan'))
+
+# id - md5 от номера строки, их же считает generated_ids
+GENERATE_SQL = """
+INSERT INTO content.genre (id, name, description, created, modified)
+SELECT md5('plan-genre-' || n)::uuid, 'Genre ' || n, '',
+       now(), now() - n * interval '1 second'
+FROM generate_series(1, %(genres)s) n;
+
+INSERT INTO content.person (id, full_name, created, modified)
+SELECT md5('plan-person-' || n)::uuid, 'Person ' || n,
+       now(), now() - n * interval '1 second'
+FROM generate_series(1, %(persons)s) n;
+
+INSERT INTO content.film_work
+    (id, title, description, rating, type, file_path, created, modified)
+SELECT md5('plan-film-' || n)::uuid, 'Film ' || n, '', 5, 'movie', '',
+       now(), now() - n * interval '1 second'
+FROM generate_series(1, %(films)s) n;
+
+INSERT INTO content.person_film_work
+    (id, film_work_id, person_id, role, created)
+SELECT gen_random_uuid(), md5('plan-film-' || n)::uuid,
+       md5('plan-person-' || ((n * %(cast)s + k) %% %(persons)s + 1))::uuid,
+       'actor', now()
+FROM generate_series(1, %(films)s) n, generate_series(0, %(cast)s - 1) k;
+
+INSERT INTO content.genre_film_work (id, film_work_id, genre_id, created)
+SELECT gen_random_uuid(), md5('plan-film-' || n)::uuid,
+       md5('plan-genre-' || ((n * %(genres_per_film)s + k)
+                             %% %(genres)s + 1))::uuid,
+       now()
+FROM generate_series(1, %(films)s) n,
+     generate_series(0, %(genres_per_film)s - 1) k;
+
+ANALYZE content.genre, content.person, content.film_work,
+    content.person_film_work, content.genre_film_work;
+"""
+
+
+def generated_ids(kind: str, count: int) -> list:
+    """id первых count сгенерированных строк вида kind."""
+    return [
+        str(uuid.UUID(hashlib.md5(f'plan-{kind}-{n}'.encode()).hexdigest()))
+        for n in range(1, count + 1)
+    ]
+
+
+def plan_nodes(cursor, query: str, params: tuple) -> list:
+    """Все узлы плана EXPLAIN запроса, обходом в глубину."""
+    cursor.execute(f'EXPLAIN (FORMAT JSON) {query}', params)
+    stack, nodes = [cursor.fetchone()[0][0]['Plan']], []
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get('Plans', []))
+    return nodes
+
+
+def seq_scanned(nodes: list) -> set:
+    return {node['Relation Name'] for node in nodes
+            if node['Node Type'] == 'Seq Scan'}
+
+
+def used_indexes(nodes: list) -> set:
+    return {node['Index Name'] for node in nodes
+            if node['Node Type'] in INDEX_SCANS}
+
+
+def table_indexes(cursor, table: str) -> set:
+    cursor.execute(
+        "SELECT indexname FROM pg_indexes "
+        "WHERE schemaname = 'content' AND tablename = %s;", (table,)
+    )
+    return {row[0] for row in cursor.fetchall()}
+
+
+class TestQueryPlans(object):
+
+    @pytest.fixture(scope='class')
+    def cursor(self):
+        """Курсор транзакции со сгенерированным каталогом.
+
+        Yields:
+            cursor
+        """
+        connection = psycopg2.connect(**dsl)
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute(GENERATE_SQL, SIZES)
+                yield cursor
+        finally:
+            connection.rollback()
+            connection.close()
+
+    @pytest.mark.parametrize('table', ['film_work', 'genre', 'person'])
+    def test_producer_page(self, table, cursor):
+        """Страница продюсера идёт по индексу (modified, id)."""
+        query = queries.columns(queries.changed_page(table, LIMIT_SIZE))
+        nodes = plan_nodes(cursor, query, START)
+
+        assert f'{table}_modified_id_idx' in used_indexes(nodes)
+        assert table not in seq_scanned(nodes)
+
+    @pytest.mark.parametrize(
+        'link_table,link_column,kind,count',
+        [('person_film_work', 'person_id', 'person', LIMIT_SIZE),
+         ('genre_film_work', 'genre_id', 'genre', 10)],
+    )
+    def test_enricher_page(self, link_table, link_column, kind, count,
+                           cursor):
+        """Связи персон и жанров страницы ищутся по индексу, без seq scan.
+
+        Какой из индексов связей взять - по персоне (жанру) или по
+        фильму, идя по film_work_modified_id_idx, - решает планировщик.
+        Жанров на странице меньше: каждый связан с множеством фильмов.
+        """
+        query = queries.columns(
+            queries.linked_films_after(link_table, link_column, LIMIT_SIZE))
+        params = (queries.uuid_array(generated_ids(kind, count)),) + START
+        nodes = plan_nodes(cursor, query, params)
+
+        assert used_indexes(nodes) & table_indexes(cursor, link_table)
+        assert link_table not in seq_scanned(nodes)
@@ -0,0 +1,103 @@
+"""Сравнение Transform и FastTransform на синтетической выборке.
+
+Запуск из каталога etl:
+    python -m benchmark.bench_transform --films 5000
+"""
+import argparse
+import random
+from datetime import datetime, timezone
+from time import perf_counter
+from typing import Callable
+from uuid import uuid4
+
+from transform import (AggregatedTransform, FastAggregatedTransform,
+                       FastTransform, Transform)
+
+ROLES = ('actor', 'writer', 'director')
+
+
+def make_films(films: int, persons: int, genres: int, seed: int) -> list:
+    """Фильмы как словари: поля film_work, персоны и жанры."""
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    return [{
+        'fw_id': str(uuid4()),
+        'title': f'Film {n}',
+        'description': 'Описание ' * rnd.randint(5, 30),
+        'rating': round(rnd.uniform(1, 10), 1),
+        'type': 'movie',
+        'created': now,
+        'modified': now,
+        'persons': [(str(uuid4()), f'Person {n}-{k}', rnd.choice(ROLES))
+                    for k in range(persons)],
+        'genre': [f'Genre {k}' for k in rnd.sample(range(30), genres)],
+    } for n in range(films)]
+
+
+def join_rows(films: list) -> list[dict]:
+    """Строки queries.films_linked: персона x жанр на фильм."""
+    rows = []
+    for film in films:
+        base = {key: film[key] for key in ('fw_id', 'title', 'description',
+                                           'rating', 'type', 'created',
+                                           'modified')}
+        for id_, full_name, role in film['persons']:
+            for name in film['genre']:
+                rows.append({**base, 'role': role, 'id': id_,
+                             'full_name': full_name, 'name': name})
+    return rows
+
+
+def aggregated_rows(films: list) -> list[dict]:
+    """Строки queries.films_aggregated: одна на фильм."""
+    rows = []
+    for film in films:
+        persons = sorted(film['persons'])
+        rows.append({
+            **{key: film[key] for key in ('fw_id', 'title', 'description',
+                                          'rating', 'type', 'created',
+                                          'modified')},
+            'director': sorted(name for _, name, role in persons
+                               if role == 'director'),
+            'actors': [{'id': id_, 'name': name}
+                       for id_, name, role in persons if role == 'actor'],
+            'writers': [{'id': id_, 'name': name}
+                        for id_, name, role in persons if role == 'writer'],
+            'genre': sorted(film['genre']),
+        })
+    return rows
+
+
+def measure(make: Callable, rows: list, repeat: int) -> tuple[float, dict]:
+    """Лучшее время Transform + сериализации из repeat прогонов."""
+    best, documents = float('inf'), {}
+    for _ in range(repeat):
+        started = perf_counter()
+        tr = make(rows)
+        tr.reformat()
+        documents = tr.documents()
+        best = min(best, perf_counter() - started)
+    return best, documents
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--films', type=int, default=5000)
+    arg_parser.add_argument('--persons', type=int, default=10)
+    arg_parser.add_argument('--genres', type=int, default=3)
+    arg_parser.add_argument('--repeat', type=int, default=3)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    films = make_films(args.films, args.persons, args.genres, args.seed)
+    cases = (
+        ('join', join_rows(films), Transform, FastTransform),
+        ('aggregate', aggregated_rows(films),
+         AggregatedTransform, FastAggregatedTransform),
+    )
+    for mode, rows, slow_class, fast_class in cases:
+        slow, slow_docs = measure(slow_class, rows, args.repeat)
+        fast, fast_docs = measure(fast_class, rows, args.repeat)
+        assert slow_docs == fast_docs, f'{mode}: documents differ'
+        print(f'{mode:9} {len(rows):8} rows  pydantic {slow:7.3f}s  '
+              f'fast {fast:7.3f}s  x{slow / fast:.1f}')
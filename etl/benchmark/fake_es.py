@@ -0,0 +1,124 @@
+"""Локальная замена elasticsearch для бенчмарков.
+
+Отвечает на те запросы, что делает ETL (проверка и создание индекса,
+_bulk), и записывает, сколько пришло запросов, байт и операций.
+Документы не хранит: меряется ETL, а не поиск.
+"""
+import json
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+
+@dataclass
+class Recorded:
+    """Что пришло на заглушку с последнего reset."""
+    requests: int = 0
+    bulk_requests: int = 0
+    bulk_bytes: int = 0
+    operations: dict[str, int] = field(default_factory=dict)
+    lock: Lock = field(default_factory=Lock, repr=False)
+
+    def add_bulk(self, size: int, operations: dict[str, int]) -> None:
+        with self.lock:
+            self.bulk_requests += 1
+            self.bulk_bytes += size
+            for op_type, count in operations.items():
+                self.operations[op_type] = \
+                    self.operations.get(op_type, 0) + count
+
+    def reset(self) -> None:
+        with self.lock:
+            self.requests = self.bulk_requests = self.bulk_bytes = 0
+            self.operations = {}
+
+
+def parse_bulk(body: bytes) -> list[tuple[str, str]]:
+    """Операции тела _bulk: (тип, id). Строки с телом пропускаются."""
+    lines = iter(line for line in body.split(b'\n') if line)
+    operations = []
+    for line in lines:
+        (op_type, meta), = json.loads(line).items()
+        operations.append((op_type, meta.get('_id')))
+        if op_type != 'delete':
+            next(lines)
+    return operations
+
+
+class FakeElasticsearch(ThreadingHTTPServer):
+    """HTTP-сервер в отдельном потоке, адрес - url."""
+    daemon_threads = True
+
+    def __init__(self, port: int = 0) -> None:
+        super().__init__(('127.0.0.1', port), _Handler)
+        self.recorded = Recorded()
+        self.indices: set[str] = set()
+        self.thread = Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def __enter__(self) -> 'FakeElasticsearch':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server: FakeElasticsearch
+
+    def log_message(self, format, *args) -> None:
+        pass  # не засоряем вывод бенчмарка
+
+    def _reply(self, status: int, payload=None) -> None:
+        body = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        # клиент 8.x проверяет, что отвечает именно elasticsearch
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def _index(self) -> str:
+        return self.path.split('?')[0].strip('/').split('/')[0]
+
+    def do_HEAD(self) -> None:
+        self.server.recorded.requests += 1
+        self._reply(200 if self._index() in self.server.indices else 404)
+
+    def do_PUT(self) -> None:
+        if self.path.split('?')[0].endswith('/_bulk'):
+            self.do_POST()
+            return
+        self.server.recorded.requests += 1
+        self._body()
+        self.server.indices.add(self._index())
+        self._reply(200, {'acknowledged': True, 'index': self._index()})
+
+    def do_POST(self) -> None:
+        self.server.recorded.requests += 1
+        body = self._body()
+        if not self.path.split('?')[0].endswith('/_bulk'):
+            self._reply(200, {'acknowledged': True})
+            return
+        operations = parse_bulk(body)
+        counts: dict[str, int] = {}
+        for op_type, _ in operations:
+            counts[op_type] = counts.get(op_type, 0) + 1
+        self.server.recorded.add_bulk(len(body), counts)
+        self._reply(200, {
+            'took': 0, 'errors': False,
+            'items': [{op_type: {'_id': id_, 'status': 200, 'result': 'ok'}}
+                      for op_type, id_ in operations],
+        })
+
+    do_GET = do_DELETE = do_POST
@@ -0,0 +1,158 @@
+"""Синтетический каталог фильмов в postgres для бенчмарков ETL.
+
+Таблицы content.* должны быть созданы миграциями movies_admin.
+Старые данные каталога удаляются. Запуск из каталога etl:
+    python -m benchmark.generate --films 100000 --hot-films 50000
+"""
+import argparse
+import io
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Iterator
+from uuid import uuid4
+
+import psycopg2
+from faker import Faker
+
+ROLES = ('actor', 'actor', 'actor', 'writer', 'director')
+TABLES = ('film_work', 'person', 'genre',
+          'person_film_work', 'genre_film_work')
+COPY_BATCH = 50_000  # строк в одном COPY
+
+
+def _copy_value(value) -> str:
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(cursor, table: str, columns: tuple, rows: Iterable) -> int:
+    """COPY строк в таблицу порциями по COPY_BATCH."""
+    query = f'COPY content.{table} ({", ".join(columns)}) FROM STDIN'
+    total, buffer, n = 0, io.StringIO(), 0
+    for row in rows:
+        buffer.write('\t'.join(map(_copy_value, row)) + '\n')
+        n += 1
+        if n == COPY_BATCH:
+            buffer.seek(0)
+            cursor.copy_expert(query, buffer)
+            total, buffer, n = total + n, io.StringIO(), 0
+    if n:
+        buffer.seek(0)
+        cursor.copy_expert(query, buffer)
+        total += n
+    return total
+
+
+def generate(connection,
+             films: int,
+             persons: int,
+             genres: int,
+             cast: int,
+             genres_per_film: int,
+             hot_films: int,
+             seed: int = 0) -> str:
+    """Заполняет каталог.
+
+    :param cast: персон на фильм
+    :param hot_films: столько фильмов получают первый («горячий») жанр,
+        его переименование - сценарий cascade
+    :return: id горячего жанра
+    """
+    fake = Faker(['ru_RU', 'en_US'])
+    Faker.seed(seed)
+    rnd = random.Random(seed)
+    now = datetime.now(timezone.utc)
+
+    def moment() -> datetime:
+        # modified за последний год, чтобы скан шёл по разным страницам
+        return now - timedelta(seconds=rnd.randint(60, 365 * 86400))
+
+    genre_ids = [str(uuid4()) for _ in range(genres)]
+    person_ids = [str(uuid4()) for _ in range(persons)]
+    film_ids = [str(uuid4()) for _ in range(films)]
+
+    def person_links() -> Iterator[tuple]:
+        for film_id in film_ids:
+            for person_id in rnd.sample(person_ids, cast):
+                yield (str(uuid4()), film_id, person_id,
+                       rnd.choice(ROLES), now)
+
+    def genre_links() -> Iterator[tuple]:
+        others = genre_ids[1:]
+        for n, film_id in enumerate(film_ids):
+            linked = rnd.sample(others, genres_per_film - (n < hot_films))
+            if n < hot_films:
+                linked.append(genre_ids[0])
+            for genre_id in linked:
+                yield str(uuid4()), film_id, genre_id, now
+
+    with connection.cursor() as cursor:
+        tables = ', '.join(f'content.{table}' for table in TABLES)
+        cursor.execute(f'TRUNCATE {tables}, content.film_work_outbox')
+        # внешние ключи Django отложенные: их проверки копились бы
+        # до commit, и ENABLE TRIGGER ниже не прошёл бы
+        cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        # триггеры очереди изменений на миллионах строк не нужны
+        for table in TABLES:
+            cursor.execute(
+                f'ALTER TABLE content.{table} DISABLE TRIGGER USER')
+        copy_rows(cursor, 'genre',
+                  ('id', 'name', 'description', 'created', 'modified'),
+                  ((id_, f'{fake.word().title()} {n}', fake.sentence(),
+                    now, moment()) for n, id_ in enumerate(genre_ids)))
+        copy_rows(cursor, 'person',
+                  ('id', 'full_name', 'created', 'modified'),
+                  ((id_, fake.name(), now, moment()) for id_ in person_ids))
+        copy_rows(cursor, 'film_work',
+                  ('id', 'title', 'description', 'creation_date', 'rating',
+                   'type', 'file_path', 'created', 'modified'),
+                  ((id_, fake.sentence(nb_words=3).rstrip('.'),
+                    fake.text(max_nb_chars=300), fake.date(),
+                    round(rnd.uniform(1, 10), 1),
+                    rnd.choice(('movie', 'tv_show')), '', now, moment())
+                   for id_ in film_ids))
+        copy_rows(cursor, 'person_film_work',
+                  ('id', 'film_work_id', 'person_id', 'role', 'created'),
+                  person_links())
+        copy_rows(cursor, 'genre_film_work',
+                  ('id', 'film_work_id', 'genre_id', 'created'),
+                  genre_links())
+        for table in TABLES:
+            cursor.execute(
+                f'ALTER TABLE content.{table} ENABLE TRIGGER USER')
+        cursor.execute('ANALYZE')
+    connection.commit()
+    return genre_ids[0]
+
+
+def add_arguments(arg_parser: argparse.ArgumentParser) -> None:
+    arg_parser.add_argument('--films', type=int, default=100_000)
+    arg_parser.add_argument('--persons', type=int, default=30_000)
+    arg_parser.add_argument('--genres', type=int, default=30)
+    arg_parser.add_argument('--cast', type=int, default=8,
+                            help='персон на фильм')
+    arg_parser.add_argument('--genres-per-film', type=int, default=3)
+    arg_parser.add_argument('--hot-films', type=int, default=50_000,
+                            help='фильмов у жанра для сценария cascade')
+    arg_parser.add_argument('--seed', type=int, default=0)
+
+
+def generate_from_args(args: argparse.Namespace) -> str:
+    # импорт здесь: конфигурация ETL читается при импорте его модулей
+    from postgres_saver import get_dsl
+
+    connection = psycopg2.connect(**get_dsl())
+    try:
+        return generate(connection, args.films, args.persons, args.genres,
+                        args.cast, args.genres_per_film, args.hot_films,
+                        args.seed)
+    finally:
+        connection.close()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    add_arguments(arg_parser)
+    print(f'Hot genre: {generate_from_args(arg_parser.parse_args())}')
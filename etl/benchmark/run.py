@@ -0,0 +1,103 @@
+"""Бенчмарк ETL: main.main против локальной заглушки elasticsearch.
+
+Сценарии:
+    full - первая синхронизация всего каталога с пустым состоянием;
+    cascade - после неё переименование «горячего» жанра
+        (generate --hot-films) и инкрементальная синхронизация.
+
+Postgres берётся из настроек DB_*, состояние ETL живёт во временном
+каталоге, elasticsearch - benchmark.fake_es. Для каждого сценария
+печатаются документы в секунду, операции bulk, время по стадиям
+конвейера и пиковый RSS процесса (он не убывает между сценариями).
+Запуск из каталога etl:
+    python -m benchmark.run --generate --films 100000 --hot-films 50000
+"""
+import argparse
+import os
+import resource
+import tempfile
+
+from benchmark import generate
+from benchmark.fake_es import FakeElasticsearch
+
+
+def isolate_state(directory: str) -> None:
+    """Кэши и лог ETL - во временный каталог, до импорта его модулей."""
+    for name, file_name in (('CACHE_MAIN', 'main.txt'),
+                            ('CACHE_PRODUCER', 'producer.txt'),
+                            ('CACHE_ENRICHER', 'enricher.txt'),
+                            ('CACHE_MERGER', 'merger.txt'),
+                            ('CACHE_DIRTY', 'dirty.txt'),
+                            ('CACHE_DIGEST', 'digest.sqlite'),
+                            ('CACHE_NAMES', 'names.sqlite'),
+                            ('CACHE_DEAD_LETTER', 'dead_letter.txt'),
+                            ('LOG_ETL', 'etl.log')):
+        os.environ[name] = os.path.join(directory, file_name)
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в linux - килобайты
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(name: str, stats: dict, fake: FakeElasticsearch) -> None:
+    recorded = fake.recorded
+    operations = sum(recorded.operations.values())
+    elapsed = stats['elapsed']
+    stages = ', '.join(f'{stage} {seconds:.2f}s'
+                       for stage, seconds in stats['stages'].items())
+    print(f'{name}: {stats["processed"]} docs indexed, '
+          f'{stats["skipped"]} skipped in {elapsed:.2f}s '
+          f'({stats["processed"] / elapsed:.1f} docs/s)')
+    print(f'  bulk: {recorded.bulk_requests} requests, '
+          f'{recorded.bulk_bytes / 2 ** 20:.1f} MiB, '
+          f'{operations} operations {recorded.operations} '
+          f'({operations / elapsed:.1f} ops/s)')
+    print(f'  stages: {stages}')
+    print(f'  peak RSS: {peak_rss_mb():.0f} MiB')
+
+
+def rename_genre(postgres_saver, genre_id: str) -> None:
+    postgres_saver.write(
+        "UPDATE content.genre SET name = name || ' *', modified = now() "
+        'WHERE id = %s;', (genre_id,)
+    )
+
+
+def hottest_genre(postgres_saver) -> str:
+    rows = postgres_saver.execute(
+        'SELECT genre_id FROM content.genre_film_work '
+        'GROUP BY genre_id ORDER BY count(*) DESC LIMIT 1;'
+    )
+    return str(rows[0]['genre_id'])
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--generate', action='store_true',
+                            help='пересоздать каталог перед прогоном')
+    arg_parser.add_argument('--scenario', default='cascade',
+                            choices=('full', 'cascade'),
+                            help='cascade идёт после full')
+    generate.add_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    isolate_state(tempfile.mkdtemp(prefix='etl-bench-'))
+    with FakeElasticsearch() as fake:
+        os.environ['ELASTIC_HOSTS'] = fake.url
+        # конфигурация ETL читается при импорте
+        import main
+        from postgres_saver import PostgresSaver
+
+        if args.generate:
+            print('Generating catalog...')
+            generate.generate_from_args(args)
+
+        fake.recorded.reset()
+        report('full', main.main(), fake)
+
+        if args.scenario == 'cascade':
+            postgres_saver = PostgresSaver()
+            rename_genre(postgres_saver, hottest_genre(postgres_saver))
+            fake.recorded.reset()
+            report('cascade', main.main(), fake)
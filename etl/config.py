@@ -1,3 +1,5 @@
+from typing import Literal
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 env_file = '.env'
@@ -11,12 +13,36 @@ class DbConf(BaseSettings):
     password: str
     host: str
     port: str
+    fetch_size: int = 1000  # размер пачки серверного курсора
+    pool_min: int = 1  # соединений пула, открытых заранее
+    pool_max: int = 8  # и не больше
 
 
 class ElasticConf(BaseSettings):
     model_config = SettingsConfigDict(env_file=env_file, env_prefix='ELASTIC_')
 
     hosts: str
+    bulk_mode: Literal['bulk', 'streaming', 'parallel', 'ndjson'] = 'ndjson'
+    chunk_size: int = 500  # документов в одном bulk-запросе
+    max_chunk_bytes: int = 10 * 1024 * 1024  # и не больше байт
+    # потоков parallel_bulk, для ndjson - предел параллельных запросов
+    thread_count: int = 4
+    skip_unchanged: bool = True  # не слать документы с прежним дайджестом
+    max_retries: int = 5  # повторов документа, отклонённого с 429/5xx
+    initial_backoff: float = 0.5  # секунд перед первым повтором
+    max_backoff: float = 30.0  # предел паузы между повторами
+    # ndjson: размер чанка и число запросов подстраиваются (AIMD)
+    adaptive: bool = True
+    min_chunk_size: int = 50  # нижняя граница chunk_size при AIMD
+    max_chunk_size: int = 5000  # верхняя граница
+    target_latency: float = 2.0  # секунд на bulk, дольше - сбавляем
+
+
+class AsyncConf(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_prefix='ASYNC_')
+
+    pool_size: int = 8  # соединений с postgres в пуле
+    concurrency: int = 4  # страниц связей в загрузке одновременно
 
 
 class CacheConf(BaseSettings):
@@ -26,6 +52,12 @@ class CacheConf(BaseSettings):
     producer: str = './cache/postgres_producer.txt'
     enricher: str = './cache/postgres_enricher.txt'
     merger: str = './cache/postgres_merger.txt'
+    dirty: str = './cache/dirty.txt'  # затронутые фильмы текущего цикла
+    digest: str = './cache/digest.sqlite'  # хеши документов в индексе
+    names: str = './cache/names.sqlite'  # имена персон и жанров в индексе
+    # документы, которые elasticsearch отклонил насовсем
+    dead_letter: str = './cache/dead_letter.txt'
+    backend: Literal['json', 'sqlite'] = 'json'
 
 
 class LogConf(BaseSettings):
@@ -39,3 +71,32 @@ class MainConf(BaseSettings):
 
     limit_size: int = 100  #
     sleep_period: int = 60  # период ожидания после выполнения скрипта
+    debounce: float = 0.2  # --daemon: окно склейки всплеска уведомлений
+    poll_interval: int = 300  # --daemon: прогон по таймеру без уведомлений
+    pipelined: bool = False  # extract/transform/load параллельно в потоках
+    queue_size: int = 4  # пачек в очереди между стадиями конвейера
+    max_dirty: int = 100_000  # фильмов в одном цикле сбора изменений
+    partial_updates: bool = True  # переименования - правкой на месте
+    # join - строка на связь фильм-персона-жанр, aggregate - строка на фильм
+    merger_mode: Literal['join', 'aggregate'] = 'join'
+    # fast - документы словарями, pydantic - модель на каждую строку
+    transform_mode: Literal['fast', 'pydantic'] = 'fast'
+    validate_sample: float = 0.01  # fast: доля документов под проверкой EsFilm
+    # modified - скан по полю modified, outbox - очередь от триггеров
+    source: Literal['modified', 'outbox'] = 'modified'
+
+
+class WorkerConf(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file, env_prefix='WORKER_')
+
+    # hash-партиций очереди на все воркеры, 0 - один процесс без аренды
+    partitions: int = 0
+
+
+class MetricsConf(BaseSettings):
+    model_config = SettingsConfigDict(env_file=env_file,
+                                      env_prefix='METRICS_')
+
+    file: str = ''  # файл для textfile-коллектора, пусто - не писать
+    host: str = '0.0.0.0'
+    port: int = 0  # порт /metrics, 0 - без HTTP
@@ -1,28 +1,426 @@
-from elasticsearch import Elasticsearch, helpers
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import lru_cache
+from time import perf_counter, sleep
+from typing import Iterator, Optional
 
-from config import ElasticConf
+from elasticsearch import ApiError, Elasticsearch, helpers
+
+from config import CacheConf, ElasticConf
+from lib import DigestStore, State, get_logger, get_storage
+from metrics import registry
 from transform import Transform
 
-elastic_conf = ElasticConf()
+logger = get_logger('etl module')
+elastic_conf, cache_conf = ElasticConf(), CacheConf()
+
+# статусы временного отказа: документ можно отправить ещё раз
+RETRY_STATUSES = (429, 502, 503, 504)
+
+# Переименование персон и жанров в документе фильма на месте.
+# params: persons - id -> имя (актёры, сценаристы),
+# directors и genres - старое имя -> новое.
+# Если какой-то персоны или старого имени в документе нет, документ
+# устарел: скрипт ничего не меняет (noop), фильм собирается целиком.
+RENAME_SCRIPT = """
+Set found = new HashSet();
+for (String field : ['actors', 'writers']) {
+  List names = new ArrayList();
+  for (def person : ctx._source[field]) {
+    if (params.persons.containsKey(person.id)) {
+      person.name = params.persons[person.id];
+      found.add(person.id);
+    }
+    names.add(person.name);
+  }
+  ctx._source[field + '_names'] = names;
+}
+for (String field : ['director', 'genre']) {
+  Map renamed = field == 'director' ? params.directors : params.genres;
+  List values = ctx._source[field];
+  for (int i = 0; i < values.size(); ++i) {
+    if (renamed.containsKey(values[i])) {
+      found.add(field + ':' + values[i]);
+      values.set(i, renamed[values[i]]);
+    }
+  }
+}
+if (found.size() < params.persons.size() + params.directors.size()
+    + params.genres.size()) {
+  ctx.op = 'noop';
+}
+"""
+
+
+@lru_cache(maxsize=None)
+def get_es_client() -> Elasticsearch:
+    """Один клиент на процесс: пул HTTP-соединений живёт между страницами.
+
+    Клиент потокобезопасен, его делят все стадии и потоки parallel_bulk.
+    """
+    return Elasticsearch(
+        hosts=elastic_conf.hosts,
+        connections_per_node=max(10, elastic_conf.thread_count),
+    )
+
+
+@lru_cache(maxsize=None)
+def get_bulk_executor() -> ThreadPoolExecutor:
+    """Потоки параллельных bulk-запросов ndjson, общие для загрузчиков.
+
+    Создаются по мере надобности, не больше thread_count.
+    """
+    return ThreadPoolExecutor(elastic_conf.thread_count,
+                              thread_name_prefix='bulk')
+
+
+@lru_cache(maxsize=None)
+def get_digest_store() -> DigestStore:
+    return DigestStore(cache_conf.digest)
+
+
+def swap_alias(es: Elasticsearch, alias: str, index: str) -> list[str]:
+    """Атомарно переключает алиас на индекс.
+
+    Если alias пока обычный индекс (создан create_elastic_index),
+    он удаляется тем же запросом - имя сразу переходит к алиасу.
+
+    :return: индексы, с которых алиас снят
+    """
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    previous = []
+    if es.indices.exists_alias(name=alias):
+        previous = list(es.indices.get_alias(name=alias))
+        actions = [{'remove': {'index': name, 'alias': alias}}
+                   for name in previous] + actions
+    elif es.indices.exists(index=alias):
+        actions.insert(0, {'remove_index': {'index': alias}})
+    es.indices.update_aliases(actions=actions)
+    return previous
+
+
+def retry_pause(attempt: int) -> float:
+    """Пауза перед повтором attempt: экспонента с полным джиттером.
+
+    Случайная пауза разводит повторы нескольких воркеров во времени,
+    чтобы они не били в перегруженный кластер одновременно.
+    """
+    ceiling = min(elastic_conf.max_backoff,
+                  elastic_conf.initial_backoff * 2 ** (attempt - 1))
+    return random.uniform(0, ceiling)
+
+
+class AdaptiveBulk:
+    """AIMD-подстройка bulk-запросов под пропускную способность кластера.
+
+    После раунда без отказов и быстрее target_latency чанк растёт
+    на min_chunk_size документов, параллельных запросов - на один
+    (additive increase). После 429/5xx или медленного раунда оба
+    делятся пополам (multiplicative decrease), как окно TCP.
+    С равными границами (ELASTIC_ADAPTIVE=false) размеры не меняются.
+    """
+
+    def __init__(self,
+                 chunk_size: int,
+                 min_chunk_size: int,
+                 max_chunk_size: int,
+                 max_concurrency: int,
+                 target_latency: float) -> None:
+        self.min_chunk_size = min(min_chunk_size, chunk_size)
+        self.max_chunk_size = max(max_chunk_size, chunk_size)
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.chunk_size = chunk_size
+        self.concurrency = 1  # начинаем осторожно, дальше разгоняемся
+
+    @classmethod
+    def from_conf(cls) -> 'AdaptiveBulk':
+        if not elastic_conf.adaptive:
+            return cls(elastic_conf.chunk_size, elastic_conf.chunk_size,
+                       elastic_conf.chunk_size, 1, elastic_conf.target_latency)
+        return cls(elastic_conf.chunk_size, elastic_conf.min_chunk_size,
+                   elastic_conf.max_chunk_size, elastic_conf.thread_count,
+                   elastic_conf.target_latency)
+
+    def round_finished(self, latency: float, throttled: bool) -> None:
+        """Итог раунда: самый долгий запрос и были ли временные отказы."""
+        if throttled or latency > self.target_latency:
+            self.chunk_size = max(self.min_chunk_size, self.chunk_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+        else:
+            self.chunk_size = min(self.max_chunk_size,
+                                  self.chunk_size + self.min_chunk_size)
+            self.concurrency = min(self.max_concurrency,
+                                   self.concurrency + 1)
+        registry.set('etl_bulk_chunk_size', self.chunk_size)
+        registry.set('etl_bulk_concurrency', self.concurrency)
+
+
+def iter_actions(ts: Transform) -> Iterator[dict]:
+    """Действия bulk-запроса по документам Transform, по одному."""
+    for filmwork_id, document in ts.documents().items():
+        yield {
+            "_index": "movies",
+            "_id": filmwork_id,
+            "_source": document
+        }
 
 
 class ElasticsearchLoader:
+    """Загрузка документов в elasticsearch.
+
+    Режимы (ELASTIC_BULK_MODE):
+        bulk - один helpers.bulk на пачку, как раньше;
+        streaming - streaming_bulk, действия берутся из генератора,
+            чанки ограничены и числом документов, и размером в байтах;
+        parallel - то же, но чанки уходят из thread_count потоков;
+        ndjson - тело bulk собирается из готовых байт документов
+            и строк действий, клиент ничего не сериализует; размер
+            чанка и число параллельных запросов подстраивает
+            AdaptiveBulk.
+
+    Документы, отклонённые временно (429, 5xx), отправляются снова
+    после паузы, не больше ELASTIC_MAX_RETRIES раз (кроме parallel:
+    parallel_bulk повторов не умеет); если отказ остался, пачка
+    поднимает BulkIndexError, когда она вся уже отправлена.
+    Отклонённые насовсем (400 - ошибка маппинга и т.п.) повтор
+    не исправит: они пишутся в CACHE_DEAD_LETTER и пропускаются,
+    чтобы цикл зафиксировался. Ошибки запроса целиком (соединение,
+    не временный статус ответа) поднимаются как есть.
+
+    С ELASTIC_SKIP_UNCHANGED документы, чей JSON не изменился
+    с прошлой загрузки (по DigestStore), в elasticsearch не уходят.
+    """
     es: Elasticsearch
-    ts: Transform
-
-    def __init__(self, transform_object: Transform) -> None:
-        self.es = Elasticsearch(hosts=elastic_conf.hosts)
-        self.ts = transform_object
-
-    def load_it(self) -> None:
-        """Загружем данные в elasticsearch."""
-
-        actions = [
-            {
-                "_index": "movies",
-                "_id": str(filmwork_id),
-                "_source": es_film.model_dump()
-            }
-            for filmwork_id, es_film in self.ts.elastic_format.items()
-        ]
-        helpers.bulk(self.es, actions=actions)
+    digests: Optional[DigestStore]
+    skipped: int
+
+    def __init__(self,
+                 es: Optional[Elasticsearch] = None,
+                 digests: Optional[DigestStore] = None,
+                 index: str = 'movies') -> None:
+        self.es = es or get_es_client()
+        self.index = index
+        # строка действия ndjson до id, одна на загрузчик
+        self.action_prefix = ('{"index":{"_index":"%s","_id":"'
+                              % index).encode()
+        if digests is None and elastic_conf.skip_unchanged:
+            digests = get_digest_store()
+        self.digests = digests
+        self.skipped = 0
+        self.bulk_mode = elastic_conf.bulk_mode
+        self.chunk_options = {
+            'chunk_size': elastic_conf.chunk_size,
+            'max_chunk_bytes': elastic_conf.max_chunk_bytes,
+        }
+        self.retry_options = {
+            'max_retries': elastic_conf.max_retries,
+            'initial_backoff': elastic_conf.initial_backoff,
+            'max_backoff': elastic_conf.max_backoff,
+        }
+        self.sizer = AdaptiveBulk.from_conf()
+        self.executor = get_bulk_executor()
+        self.dead_letters = State(get_storage(cache_conf.dead_letter))
+
+    def load_it(self, ts: Transform) -> int:
+        """Загружем данные в elasticsearch.
+
+        :return: число проиндексированных документов
+        """
+        documents = ts.documents()
+        hashes = None
+        if self.digests is not None:
+            hashes = self.digests.changed(documents)
+            self.skipped += len(documents) - len(hashes)
+            registry.inc('etl_docs_skipped_total',
+                         len(documents) - len(hashes))
+            if not hashes:
+                return 0
+            documents = {id_: documents[id_] for id_ in hashes}
+        # _source уже JSON-байты, сериализатор клиента отдаёт их как есть
+        actions = ({'_index': self.index, '_id': id_, '_source': document}
+                   for id_, document in documents.items())
+
+        if self.bulk_mode == 'ndjson':
+            _, errors = self.bulk_ndjson(documents)
+        elif self.bulk_mode == 'bulk':
+            _, errors = helpers.bulk(self.es, actions=actions,
+                                     raise_on_error=False,
+                                     **self.chunk_options,
+                                     **self.retry_options)
+        else:
+            if self.bulk_mode == 'parallel':
+                results = helpers.parallel_bulk(
+                    self.es, actions,
+                    thread_count=elastic_conf.thread_count,
+                    queue_size=elastic_conf.thread_count,
+                    raise_on_error=False,
+                    **self.chunk_options,
+                )
+            else:
+                results = helpers.streaming_bulk(self.es, actions,
+                                                 raise_on_error=False,
+                                                 **self.chunk_options,
+                                                 **self.retry_options)
+            errors = [info for ok, info in results if not ok]
+        failed = {item['_id'] for error in errors
+                  for item in error.values()}
+        indexed = [id_ for id_ in documents if id_ not in failed]
+        registry.inc('etl_docs_indexed_total', len(indexed))
+        if hashes:
+            # дайджесты - только принятых документов
+            self.digests.update({id_: hashes[id_] for id_ in indexed})
+        if errors:
+            registry.inc('etl_bulk_errors_total', len(errors))
+            self.dead_letter(errors)
+        self.forget_dead_letters(indexed)
+        return len(indexed)
+
+    def dead_letter(self, errors: list[dict]) -> None:
+        """Отклонённые документы: постоянные отказы - в CACHE_DEAD_LETTER.
+
+        Временные отказы, оставшиеся после повторов, прерывают
+        прогон: курсоры не сдвинутся, и документы уйдут снова.
+        """
+        items = [item for error in errors for item in error.values()]
+        transient = [item for item in items
+                     if item.get('status') in RETRY_STATUSES]
+        if transient:
+            raise helpers.BulkIndexError(
+                f'{len(transient)} document(s) failed to index.', errors
+            )
+        documents = self.dead_letters.get_state('documents') or {}
+        now = datetime.now(timezone.utc)
+        for item in items:
+            logger.error(f'Document {item["_id"]} rejected: '
+                         f'{item.get("status")} {item.get("error")}')
+            documents[item['_id']] = {'status': item.get('status'),
+                                      'error': item.get('error'),
+                                      'at': now}
+        registry.inc('etl_docs_dead_lettered_total', len(items))
+        self.dead_letters.set_state('documents', documents)
+        self.dead_letters.flush()
+
+    def forget_dead_letters(self, ids: list[str]) -> None:
+        """Убирает из CACHE_DEAD_LETTER документы, принятые теперь."""
+        documents = self.dead_letters.get_state('documents')
+        if not documents or documents.keys().isdisjoint(ids):
+            return
+        for id_ in ids:
+            documents.pop(id_, None)
+        self.dead_letters.set_state('documents', documents)
+        self.dead_letters.flush()
+
+    def bulk_ndjson(self, documents: dict[str, bytes]
+                    ) -> tuple[list[str], list[dict]]:
+        """Bulk-запросы из готовых строк NDJSON.
+
+        Документы уходят раундами: sizer.concurrency запросов
+        по sizer.chunk_size документов (и не больше max_chunk_bytes)
+        параллельно. Временно отклонённые документы встают в начало
+        очереди и уходят в следующем раунде после паузы retry_pause.
+
+        :return: id принятых документов и ответы по отклонённым
+        """
+        pending = deque(documents)
+        attempts: dict[str, int] = {}
+        indexed, errors = [], []
+        while pending:
+            chunks = self.take_chunks(pending, documents)
+            results = self.executor.map(self.send_lines,
+                                        [lines for _, lines in chunks])
+            retry, latency = [], 0.0
+            for (ids, _), (items, elapsed) in zip(chunks, results):
+                latency = max(latency, elapsed)
+                for id_, item in zip(ids, items):
+                    if 'error' not in item:
+                        indexed.append(id_)
+                    elif item['status'] in RETRY_STATUSES and \
+                            attempts.get(id_, 0) < elastic_conf.max_retries:
+                        attempts[id_] = attempts.get(id_, 0) + 1
+                        retry.append(id_)
+                    else:
+                        errors.append({'index': {'_id': id_, **item}})
+            self.sizer.round_finished(latency, throttled=bool(retry))
+            if retry:
+                registry.inc('etl_bulk_retries_total', len(retry))
+                sleep(retry_pause(max(attempts[id_] for id_ in retry)))
+                pending.extendleft(reversed(retry))
+        return indexed, errors
+
+    def take_chunks(self,
+                    pending: deque,
+                    documents: dict[str, bytes]
+                    ) -> list[tuple[list[str], list[bytes]]]:
+        """Чанки следующего раунда: (id документов, строки тела)."""
+        max_chunk_bytes = self.chunk_options['max_chunk_bytes']
+        chunks = []
+        while pending and len(chunks) < self.sizer.concurrency:
+            ids, lines, size = [], [], 0
+            while pending and len(ids) < self.sizer.chunk_size:
+                id_ = pending[0]
+                action = self.action_prefix + id_.encode() + b'"}}'
+                line_size = len(action) + len(documents[id_]) + 2  # и \n
+                if ids and size + line_size > max_chunk_bytes:
+                    break
+                pending.popleft()
+                ids.append(id_)
+                lines += (action, documents[id_])
+                size += line_size
+            chunks.append((ids, lines))
+        return chunks
+
+    def send_lines(self, lines: list[bytes]) -> tuple[list[dict], float]:
+        """Один bulk-запрос: ответы по документам и время запроса.
+
+        Запрос, отклонённый целиком с 429/5xx (клиент уже повторил
+        его сам), даёт этот статус каждому документу.
+        """
+        started = perf_counter()
+        try:
+            # строки склеит в одно тело NdjsonSerializer клиента, без JSON
+            response = self.es.bulk(operations=lines)
+            items = [item['index'] for item in response['items']]
+        except ApiError as exc:
+            if exc.status_code not in RETRY_STATUSES:
+                raise
+            items = [{'status': exc.status_code, 'error': str(exc)}
+                     for _ in range(len(lines) // 2)]
+        return items, perf_counter() - started
+
+    def patch_names(self, patches: dict[str, dict]) -> list[str]:
+        """Частичные обновления фильмов скриптом RENAME_SCRIPT.
+
+        :param patches: id фильма -> params скрипта
+        :return: id фильмов, которых ещё нет в индексе, в чьих
+            документах нет прежних имён (скрипт ответил noop) или
+            которые скрипт не обновил насовсем: их соберут целиком
+        """
+        actions = ({'_op_type': 'update', '_index': self.index, '_id': id_,
+                    'retry_on_conflict': 3,
+                    'script': {'source': RENAME_SCRIPT, 'lang': 'painless',
+                               'params': params}}
+                   for id_, params in patches.items())
+        missing, errors = [], []
+        for ok, info in helpers.streaming_bulk(self.es, actions,
+                                               raise_on_error=False,
+                                               **self.chunk_options,
+                                               **self.retry_options):
+            if ok and info['update'].get('result') != 'noop':
+                registry.inc('etl_docs_patched_total')
+                continue
+            if ok or info['update']['status'] not in RETRY_STATUSES:
+                missing.append(info['update']['_id'])
+            else:
+                errors.append(info)
+        if self.digests is not None:
+            # документы изменены в обход загрузчика
+            self.digests.discard(patches)
+        if errors:
+            registry.inc('etl_bulk_errors_total', len(errors))
+            raise helpers.BulkIndexError(
+                f'{len(errors)} document(s) failed to update.', errors
+            )
+        return missing
@@ -1,12 +1,25 @@
+import abc
+import hashlib
 import json
 import logging
-from typing import Any
+import os
+import sqlite3
+import tempfile
+import threading
+from array import array
+from base64 import b64decode, b64encode
+from datetime import datetime, timedelta, timezone
+from typing import Any, Iterable, Optional
+from uuid import UUID
 
 from django.core.serializers.json import DjangoJSONEncoder
 
-from config import LogConf
+from config import CacheConf, LogConf
 
-log_conf = LogConf()
+log_conf, cache_conf = LogConf(), CacheConf()
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MICROSECOND = timedelta(microseconds=1)
 
 
 class CacheStates:
@@ -15,10 +28,24 @@ class CacheStates:
     ERROR = 'error'
 
 
-class JsonFileStorage:
+class BaseStorage(abc.ABC):
+    """Хранилище состояния: сохраняет и отдаёт словарь целиком."""
+
+    @abc.abstractmethod
+    def save_state(self, state: dict[str, Any]) -> None:
+        """Сохранить состояние в хранилище."""
+
+    @abc.abstractmethod
+    def retrieve_state(self) -> dict[str, Any]:
+        """Получить состояние из хранилища."""
+
+
+class JsonFileStorage(BaseStorage):
     """Реализация хранилища, использующего локальный файл.
 
     Формат хранения: JSON
+    Запись атомарная: временный файл + fsync + rename, поэтому
+    падение посреди записи не оставит файл обрезанным.
     """
 
     def __init__(self, file_path: str) -> None:
@@ -28,11 +55,21 @@ class JsonFileStorage:
         """Сохранить состояние в хранилище."""
         json_state = json.dumps(state,
                                 sort_keys=True,
-                                indent=1,
+                                separators=(',', ':'),
                                 cls=DjangoJSONEncoder  # из-за datetime
                                 )
-        with open(self.file_path, 'w+') as file_:
-            file_.write(json_state)
+        directory = os.path.dirname(os.path.abspath(self.file_path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.state-')
+        try:
+            with os.fdopen(fd, 'w') as file_:
+                file_.write(json_state)
+                file_.flush()
+                os.fsync(file_.fileno())
+            os.replace(tmp_path, self.file_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
 
     def retrieve_state(self) -> dict[str, Any]:
         """Получить состояние из хранилища."""
@@ -45,26 +82,258 @@ class JsonFileStorage:
             return {}
 
 
+class SqliteStorage(BaseStorage):
+    """Хранилище состояния в SQLite в режиме WAL.
+
+    Ключ - строка таблицы, значение - JSON. Сохранение - одна транзакция.
+    """
+
+    def __init__(self, file_path: str) -> None:
+        self.file_path = file_path
+        # состояние пишет поток загрузки конвейера, а создаёт основной
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # в WAL NORMAL не ломает базу при сбое, теряется лишь последний commit
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS state '
+            '(key TEXT PRIMARY KEY, value TEXT NOT NULL)'
+        )
+
+    def save_state(self, state: dict[str, Any]) -> None:
+        """Сохранить состояние в хранилище."""
+        rows = [(key, json.dumps(value, cls=DjangoJSONEncoder))
+                for key, value in state.items()]
+        with self.connection:
+            self.connection.execute('DELETE FROM state')
+            self.connection.executemany(
+                'INSERT INTO state (key, value) VALUES (?, ?)', rows
+            )
+
+    def retrieve_state(self) -> dict[str, Any]:
+        """Получить состояние из хранилища."""
+        rows = self.connection.execute('SELECT key, value FROM state')
+        return {key: json.loads(value) for key, value in rows}
+
+
+class DigestStore:
+    """Дайджесты проиндексированных документов: id -> хеш JSON.
+
+    Лежит в SQLite рядом с состоянием. Загрузчик отбрасывает документы,
+    чей хеш совпал с сохранённым, и записывает новые хеши только
+    после ответа elasticsearch.
+    """
+    batch_size = 500  # id в одном IN, ниже лимита переменных SQLite
+
+    def __init__(self, file_path: str) -> None:
+        # одно соединение на потоки извлечения и загрузки
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS digest '
+            '(id TEXT PRIMARY KEY, hash BLOB NOT NULL) WITHOUT ROWID'
+        )
+
+    @staticmethod
+    def digest(document: bytes) -> bytes:
+        return hashlib.blake2b(document, digest_size=16).digest()
+
+    def changed(self, documents: dict[str, bytes]) -> dict[str, bytes]:
+        """Хеши документов, которых нет в хранилище или которые изменились."""
+        hashes = {id_: self.digest(doc) for id_, doc in documents.items()}
+        ids = list(hashes)
+        stored = {}
+        with self.lock:
+            for n in range(0, len(ids), self.batch_size):
+                part = ids[n:n + self.batch_size]
+                stored.update(self.connection.execute(
+                    'SELECT id, hash FROM digest '
+                    f'WHERE id IN ({",".join("?" * len(part))})', part
+                ))
+        return {id_: hash_ for id_, hash_ in hashes.items()
+                if stored.get(id_) != hash_}
+
+    def update(self, hashes: dict[str, bytes]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO digest (id, hash) VALUES (?, ?)',
+                hashes.items()
+            )
+
+    def discard(self, ids: Iterable[str]) -> None:
+        """Забыть документы, изменённые в индексе в обход загрузчика."""
+        with self.lock, self.connection:
+            self.connection.executemany('DELETE FROM digest WHERE id = ?',
+                                        ((str(id_),) for id_ in ids))
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM digest')
+
+
+class NameStore:
+    """Последние проиндексированные имена персон и жанров: id -> имя.
+
+    По ним отличается переименование (имя изменилось) от правки,
+    которая документов в индексе не касается (имя прежнее).
+    """
+    batch_size = DigestStore.batch_size
+
+    def __init__(self, file_path: str) -> None:
+        # одно соединение на потоки извлечения и загрузки
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS name '
+            '(kind TEXT, id TEXT, name TEXT, PRIMARY KEY (kind, id)) '
+            'WITHOUT ROWID'
+        )
+
+    def get(self, kind: str, ids: Iterable[str]) -> dict[str, str]:
+        ids = [str(id_) for id_ in ids]
+        names = {}
+        with self.lock:
+            for n in range(0, len(ids), self.batch_size):
+                part = ids[n:n + self.batch_size]
+                names.update(self.connection.execute(
+                    'SELECT id, name FROM name '
+                    f'WHERE kind = ? AND id IN ({",".join("?" * len(part))})',
+                    [kind, *part]
+                ))
+        return names
+
+    def update(self, kind: str, names: dict[str, str]) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO name (kind, id, name) '
+                'VALUES (?, ?, ?)',
+                ((kind, id_, name) for id_, name in names.items())
+            )
+
+    def discard(self, kind: str, ids: Iterable[str]) -> None:
+        """Забыть имена, проиндексированные в обход частичных обновлений."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'DELETE FROM name WHERE kind = ? AND id = ?',
+                ((kind, str(id_)) for id_ in ids)
+            )
+
+    def clear(self) -> None:
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM name')
+
+
+def pack_ids(ids: Iterable) -> str:
+    """uuid подряд по 16 байт, в base64."""
+    return b64encode(b''.join(UUID(str(id_)).bytes for id_ in ids)).decode()
+
+
+def ids_from_bytes(raw: bytes) -> list[str]:
+    """uuid по 16 байт подряд - в строки, через один hex() на все."""
+    hexed = raw.hex()
+    return [f'{hexed[n:n + 8]}-{hexed[n + 8:n + 12]}-{hexed[n + 12:n + 16]}'
+            f'-{hexed[n + 16:n + 20]}-{hexed[n + 20:n + 32]}'
+            for n in range(0, len(hexed), 32)]
+
+
+def unpack_ids(packed: str) -> list[str]:
+    return ids_from_bytes(b64decode(packed))
+
+
+class RowBatch:
+    """Страница строк (id, modified) в колонках.
+
+    ids - uuid по 16 байт подряд, modified - array('q') микросекунд
+    от эпохи. Postgres отдаёт страницу сразу колонками
+    (queries.columns), поэтому максимум modified, уникальные id
+    и их список считаются над буферами, без dict на каждую строку.
+    """
+    __slots__ = ('ids', 'modified')
+
+    def __init__(self, ids: bytes = b'',
+                 modified: Optional[array] = None) -> None:
+        self.ids = ids
+        self.modified = array('q') if modified is None else modified
+
+    @classmethod
+    def from_row(cls, row: dict) -> 'RowBatch':
+        """Из строки запроса queries.columns."""
+        return cls(bytes(row['ids']), array('q', row['modified']))
+
+    def __len__(self) -> int:
+        return len(self.modified)
+
+    def __getitem__(self, n: int) -> dict:
+        """Строка n так, как её отдал бы postgres (для курсоров)."""
+        n = range(len(self))[n]
+        return {'id': ids_from_bytes(self.ids[16 * n:16 * n + 16])[0],
+                'modified': EPOCH + self.modified[n] * MICROSECOND}
+
+    def max_modified(self) -> Optional[datetime]:
+        if not self.modified:
+            return None
+        return EPOCH + max(self.modified) * MICROSECOND
+
+    def id_keys(self) -> set[bytes]:
+        """Уникальные id по 16 байт - для множеств без строк uuid."""
+        raw = self.ids
+        return {raw[n:n + 16] for n in range(0, len(raw), 16)}
+
+    def id_list(self) -> list[str]:
+        return ids_from_bytes(self.ids)
+
+    def pack(self) -> dict[str, str]:
+        """Обе колонки в base64, чтобы жить в JSON-состоянии."""
+        return {'ids': b64encode(self.ids).decode(),
+                'modified': b64encode(self.modified.tobytes()).decode()}
+
+    @classmethod
+    def unpack(cls, packed: dict[str, str]) -> 'RowBatch':
+        modified = array('q')
+        modified.frombytes(b64decode(packed['modified']))
+        return cls(b64decode(packed['ids']), modified)
+
+
+def get_storage(file_path: str) -> BaseStorage:
+    """Хранилище по настройке CACHE_BACKEND.
+
+    Для sqlite расширение файла заменяется на .sqlite.
+    """
+    if cache_conf.backend == 'sqlite':
+        return SqliteStorage(os.path.splitext(file_path)[0] + '.sqlite')
+    return JsonFileStorage(file_path)
+
+
 class State:
-    """Класс для работы с состояниями."""
+    """Класс для работы с состояниями.
 
-    def __init__(self, storage: JsonFileStorage) -> None:
+    Держит копию состояния в памяти: хранилище читается один раз,
+    а пишется целиком в flush(), на границах контрольных точек.
+    """
+
+    def __init__(self, storage: BaseStorage) -> None:
         self.storage = storage
+        self.data = storage.retrieve_state()
+        self.dirty = False
 
     def set_state(self, key: str, value: Any) -> None:
-        """Установить состояние для определённого ключа."""
-        data = self.storage.retrieve_state()
-        data[key] = value
-        self.storage.save_state(data)
+        """Установить состояние для определённого ключа (в памяти)."""
+        self.data[key] = value
+        self.dirty = True
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу."""
-        data = self.storage.retrieve_state()
-        try:
-            result = data[key]
-        except KeyError:
-            result = None
-        return result
+        return self.data.get(key)
+
+    def flush(self) -> None:
+        """Записать состояние в хранилище, если оно менялось."""
+        if self.dirty:
+            self.storage.save_state(self.data)
+            self.dirty = False
 
 
 def get_logger(logger_name: str) -> logging.Logger:
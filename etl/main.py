@@ -1,20 +1,31 @@
+import argparse
 import json
-from datetime import datetime
-from time import sleep
+from datetime import datetime, timezone
+from functools import lru_cache, partial
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from typing import Iterator, Optional, Union
 
 from dateutil.parser import parser
-from elasticsearch import Elasticsearch
 
-from config import CacheConf, ElasticConf, MainConf
-from elasticsearch_loader import ElasticsearchLoader
-from lib import CacheStates, JsonFileStorage, State, get_logger
-from postgres_operations import (PostgresEnricher, PostgresMerger,
-                                 PostgresProducer)
-from postgres_saver import PostgresSaver
-from transform import Transform
+from config import CacheConf, MainConf, WorkerConf
+from elasticsearch_loader import (ElasticsearchLoader, get_digest_store,
+                                  get_es_client, swap_alias)
+from lib import (CacheStates, NameStore, State, get_logger, get_storage,
+                 ids_from_bytes, pack_ids, unpack_ids)
+from metrics import registry, start_http_server, write_file
+from pipeline import Checkpoint, Pipeline
+from postgres_operations import (OUTBOX_CHANNEL, Cursor, PostgresEnricher,
+                                 PostgresMerger, PostgresOutbox,
+                                 PostgresProducer, PostgresRenames)
+from postgres_saver import (PartitionLeases, PostgresListener,
+                            PostgresSaver, ReindexLock)
+from transform import (AggregatedTransform, FastAggregatedTransform,
+                       FastTransform, Transform)
 
 logger = get_logger('etl module')
-main_conf, cache_conf, elastic_conf = MainConf(), CacheConf(), ElasticConf()
+main_conf, cache_conf, worker_conf = MainConf(), CacheConf(), WorkerConf()
+AGGREGATED = main_conf.merger_mode == 'aggregate'
 
 
 def max_date(last_date: datetime, new_date: datetime) -> datetime:
@@ -24,46 +35,377 @@ def max_date(last_date: datetime, new_date: datetime) -> datetime:
     return last_date
 
 
+def load_cursors(state: State, modified_after: datetime) -> dict[str, Cursor]:
+    """Курсоры потоков продюсера из состояния.
+
+    Если курсора потока ещё нет (первый запуск или состояние
+    старого формата), поток начинается с modified_after.
+    """
+    cached = state.get_state('cursors') or {}
+    return {
+        stream: Cursor.model_validate(cached[stream]) if stream in cached
+        else Cursor(modified=modified_after)
+        for stream in PostgresProducer.streams
+    }
+
+
+def dump_cursors(cursors: dict[str, Cursor]) -> dict:
+    # mode='json' сохраняет микросекунды, DjangoJSONEncoder их обрезает
+    return {stream: cursor.model_dump(mode='json')
+            for stream, cursor in cursors.items()}
+
+
+def load_schema() -> dict:
+    with open('./create_schema/create_schema.json') as file_:
+        data = file_.read()
+        return json.loads(data)
+
+
 def create_elastic_index() -> None:
     """Проверяем наличие индекса, создаём при необходимости."""
     logger.info('Checking the presence of the index.')
-    es = Elasticsearch(hosts=elastic_conf.hosts)
+    es = get_es_client()
     if not es.indices.exists(index='movies'):
         logger.info('Create index.')
-        with open('./create_schema/create_schema.json') as file_:
-            data = file_.read()
-            data = json.loads(data)
-            es.indices.create(index='movies',
-                              settings=data['settings'],
-                              mappings=data['mappings'],)
+        data = load_schema()
+        es.indices.create(index='movies',
+                          settings=data['settings'],
+                          mappings=data['mappings'],)
+        # индекс пуст: прежние дайджесты и имена больше ничего не значат
+        get_digest_store().clear()
+        NameStore(cache_conf.names).clear()
         logger.info('Index created.')
 
 
-def main() -> None:
+class Extractor:
+    """Извлечение изменённых фильмов из postgres.
+
+    Цикл идёт в две фазы. Сначала страницы всех трёх потоков продюсера
+    и их связи сводятся в множество затронутых фильмов (не больше
+    MAIN_MAX_DIRTY), затем каждый фильм множества собирается
+    и отдаётся для Transform ровно один раз - даже если его задели
+    несколько персон, жанров и правка самого фильма.
+
+    Множество сохраняется отдельно (CACHE_DIRTY) до начала сборки,
+    прогресс сборки - Checkpoint с dirty_done после каждого куска,
+    курсоры следующего цикла и modified_after фиксируются Checkpoint
+    после загрузки всего множества. Checkpoint доходит до commit только
+    после ответа elasticsearch на bulk всех пачек перед ним, поэтому
+    после падения заново делается не больше одного куска.
+
+    В режиме MAIN_PIPELINED конец цикла фиксируется в потоке загрузки,
+    когда извлечение уже может сохранять множество следующего цикла,
+    поэтому CACHE_DIRTY меняется под блокировкой и очищается, только
+    если в нём всё ещё множество завершённого цикла.
+
+    Очередь content.film_work_outbox (её триггеры пишут при любом
+    MAIN_SOURCE) этому режиму не нужна: с outbox в конце цикла
+    удаляются строки, записанные до его начала.
+
+    С загрузчиком (MAIN_PARTIAL_UPDATES) переименованные персоны
+    и жанры в множество не попадают: их фильмы правятся на месте.
+    Правки уходят после сбора множества и после Checkpoint с barrier:
+    документы с прежним именем, ещё стоящие в очереди конвейера,
+    не перезапишут правку.
+    """
+    last_max_modified: Optional[datetime]
+
+    def __init__(self,
+                 postgres_saver: PostgresSaver,
+                 limit_size: int,
+                 modified_after: datetime,
+                 cursors: dict[str, Cursor],
+                 dirty_done: int = 0,
+                 max_dirty: int = 100_000,
+                 loader: Optional[ElasticsearchLoader] = None,
+                 outbox: Optional[PostgresOutbox] = None) -> None:
+        self.postgres_saver = postgres_saver
+        self.limit_size = limit_size
+        self.modified_after = modified_after
+        self.cursors = cursors
+        self.dirty_done = dirty_done
+        self.max_dirty = max_dirty
+        self.dirty_state = State(get_storage(cache_conf.dirty))
+        self.dirty_lock = Lock()
+        # с загрузчиком переименования идут частичными обновлениями
+        self.loader = loader
+        self.renames = None
+        self.patches = []  # правки фильмов, собранные в этом цикле
+        self.outbox = outbox
+        if loader is not None:
+            self.renames = PostgresRenames(postgres_saver,
+                                           NameStore(cache_conf.names))
+        self.last_max_modified = None
+
+    def track(self, max_modified: datetime) -> None:
+        self.last_max_modified = max_date(self.last_max_modified,
+                                          max_modified)
+
+    def collect_dirty(self, cursors: dict[str, Cursor]
+                      ) -> tuple[list[str], dict[str, Cursor], bool]:
+        """Фаза 1: id затронутых фильмов со страниц продюсера.
+
+        :return: отсортированные id, курсоры после собранных страниц
+            и признак, что изменения закончились
+        """
+        limit_size, modified_after = self.limit_size, self.modified_after
+        dirty: set[bytes] = set()  # id по 16 байт, как в RowBatch
+        while len(dirty) < self.max_dirty:
+            pp = PostgresProducer(self.postgres_saver, limit_size,
+                                  modified_after, cursors)
+            pp.collect()
+            if not pp.has_results:  # событие остановки
+                return ids_from_bytes(b''.join(sorted(dirty))), cursors, True
+            self.track(pp.max_modified_after)
+            dirty.update(pp.results['get_filmwork'].id_keys())
+            persons_uuid, genres_uuid = self.collect_renames(pp)
+
+            link_cursors = None
+            while True:
+                pe = PostgresEnricher(pp, limit_size, modified_after,
+                                      link_cursors, persons_uuid, genres_uuid)
+                pe.collect()
+                if not pe.has_results:  # событие остановки
+                    break
+                self.track(pe.max_modified_after)
+                dirty.update(pe.results['get_person_links'].id_keys())
+                dirty.update(pe.results['get_genre_links'].id_keys())
+                link_cursors = pe.next_cursors()
+            cursors = pp.next_cursors()
+        # байты uuid сортируются так же, как их строки
+        return ids_from_bytes(b''.join(sorted(dirty))), cursors, False
+
+    def collect_renames(self, pp: PostgresProducer
+                        ) -> tuple[Optional[list], Optional[list]]:
+        """Переименования страницы продюсера - в правки self.patches.
+
+        :return: id персон и жанров, чьи фильмы нужно пересобрать
+            целиком (None - все со страницы)
+        """
+        if self.renames is None:
+            return None, None
+        persons, renamed_persons = self.renames.split(
+            'person', pp.results['get_person'].id_list())
+        genres, renamed_genres = self.renames.split(
+            'genre', pp.results['get_genre'].id_list())
+        if renamed_persons or renamed_genres:
+            self.patches.append(self.renames.film_patches(renamed_persons,
+                                                          renamed_genres))
+        return persons, genres
+
+    def apply_patches(self, dirty: list[str]) -> list[str]:
+        """Правки цикла по порядку страниц.
+
+        :return: множество цикла вместе с фильмами, которые
+            пришлось собрать целиком (их нет в индексе или
+            в их документах нет прежних имён)
+        """
+        ids = set(dirty)
+        for patches in self.patches:
+            ids.update(self.loader.patch_names(patches))
+        self.patches = []
+        return sorted(ids)
+
+    def save_dirty(self,
+                   cursors: dict[str, Cursor],
+                   dirty: list[str],
+                   next_cursors: dict[str, Cursor]) -> None:
+        with self.dirty_lock:
+            self.dirty_state.set_state('from', dump_cursors(cursors))
+            self.dirty_state.set_state('ids', pack_ids(dirty))
+            self.dirty_state.set_state('cursors', dump_cursors(next_cursors))
+            self.dirty_state.flush()
+
+    def load_dirty(self, cursors: dict[str, Cursor]
+                   ) -> Optional[tuple[list[str], dict[str, Cursor]]]:
+        """Множество прерванного цикла, начатого с этих же курсоров."""
+        with self.dirty_lock:
+            if self.dirty_state.get_state('from') != dump_cursors(cursors):
+                return None
+            next_cursors = {
+                stream: Cursor.model_validate(cursor) for stream, cursor
+                in self.dirty_state.get_state('cursors').items()
+            }
+            return unpack_ids(self.dirty_state.get_state('ids')), next_cursors
+
+    def clear_dirty(self, cursors: dict[str, Cursor]) -> None:
+        """Забывает множество цикла, начатого с этих курсоров.
+
+        Если извлечение уже сохранило множество следующего цикла,
+        оно остаётся.
+        """
+        with self.dirty_lock:
+            if self.dirty_state.get_state('from') != dump_cursors(cursors):
+                return
+            for key in ('from', 'ids', 'cursors'):
+                self.dirty_state.set_state(key, None)
+            self.dirty_state.flush()
+
+    def finish_cycle(self,
+                     cursors: dict[str, Cursor],
+                     names: Optional[dict],
+                     outbox_id: Optional[int]) -> None:
+        """Цикл, начатый с cursors, загружен, курсоры сдвинуты."""
+        self.clear_dirty(cursors)
+        if names:
+            self.renames.remember_pending(names)
+        if outbox_id:
+            self.outbox.prune(outbox_id)
+
+    def __iter__(self) -> Iterator[Union[list, Checkpoint]]:
+        cursors, done = self.cursors, self.dirty_done
+        while True:
+            # строки очереди до начала цикла он покрывает
+            outbox_id = self.outbox.max_id() if self.outbox else None
+            resumed = self.load_dirty(cursors)
+            if resumed:
+                (dirty, next_cursors), exhausted = resumed, False
+            else:
+                dirty, next_cursors, exhausted = self.collect_dirty(cursors)
+                if self.patches:
+                    # пачки прошлого цикла сначала ложатся в индекс
+                    yield Checkpoint({}, barrier=True)
+                    dirty = self.apply_patches(dirty)
+                if not dirty and next_cursors == cursors:
+                    if outbox_id:
+                        # правки связей без modified: этот режим их не видит
+                        yield Checkpoint({}, partial(self.outbox.prune,
+                                                     outbox_id))
+                    return
+                self.save_dirty(cursors, dirty, next_cursors)
+                done = 0
+
+            # Фаза 2: сборка кусками, в памяти не больше пачки курсора
+            for start in range(done, len(dirty), self.limit_size):
+                chunk = dirty[start:start + self.limit_size]
+                pm = PostgresMerger(self.postgres_saver, self.modified_after,
+                                    chunk, aggregated=AGGREGATED)
+                yield from pm.iter_films_linked()
+                self.track(pm.max_modified_after)
+                yield Checkpoint({'dirty_done': start + len(chunk)})
+
+            names = self.renames.take_pending() if self.renames else None
+            values = {'cursors': dump_cursors(next_cursors), 'dirty_done': 0}
+            if self.last_max_modified:
+                # не ждём конца прогона: после падения не с начала
+                values['modified_after'] = self.last_max_modified
+            yield Checkpoint(values, partial(self.finish_cycle, cursors,
+                                             names, outbox_id))
+            cursors, done = next_cursors, 0
+            if exhausted:
+                return
+
+
+class OutboxExtractor:
+    """Извлечение фильмов из очереди изменений content.film_work_outbox.
+
+    Каждый цикл трогает только реально изменённые фильмы. Строки
+    очереди удаляются в Checkpoint, после загрузки их фильмов.
+    """
+    last_max_modified: Optional[datetime]
+
+    def __init__(self,
+                 postgres_saver: PostgresSaver,
+                 ack_saver: PostgresSaver,
+                 limit_size: int,
+                 modified_after: datetime,
+                 leases: Optional[PartitionLeases] = None) -> None:
+        partitions = leases.rebalance() if leases else None
+        self.outbox = PostgresOutbox(postgres_saver, ack_saver, limit_size,
+                                     partitions, leases.total if leases else 0)
+        self.leases = leases
+        self.postgres_saver = postgres_saver
+        self.modified_after = modified_after
+        self.last_max_modified = None
+
+    def __iter__(self) -> Iterator[Union[list, Checkpoint]]:
+        while True:
+            if self.leases and not self.leases.alive():
+                # блокировки потеряны, партиции могли уйти другому воркеру
+                logger.warning('Partition leases lost, stopping the run.')
+                return
+            rows = self.outbox.get_batch()
+            if not rows:  # событие остановки
+                return
+
+            pm = PostgresMerger(self.postgres_saver, self.modified_after,
+                                {row['film_work_id'] for row in rows},
+                                aggregated=AGGREGATED)
+            yield from pm.iter_films_linked()
+            self.last_max_modified = max_date(self.last_max_modified,
+                                              pm.max_modified_after)
+            ids = [row['id'] for row in rows]
+            yield Checkpoint({}, partial(self.ack, ids))
+
+    def ack(self, ids: list) -> None:
+        """Удаляет строки очереди, если партиции всё ещё наши."""
+        if self.leases and not self.leases.alive():
+            # партиции мог взять другой воркер: строки обработает и он
+            logger.warning('Partition leases lost, the batch stays queued.')
+            return
+        self.outbox.ack(ids)
+
+
+@lru_cache
+def get_leases() -> PartitionLeases:
+    """Аренда партиций на весь процесс: блокировки живут с соединением."""
+    return PartitionLeases(worker_conf.partitions)
+
+
+@lru_cache
+def get_reindex_lock() -> ReindexLock:
+    """ReindexLock на весь процесс: одно соединение на все прогоны."""
+    return ReindexLock()
+
+
+def transform(films_linked: list) -> Transform:
+    if main_conf.transform_mode == 'fast':
+        fast_class = FastAggregatedTransform if AGGREGATED else FastTransform
+        tr = fast_class(films_linked, main_conf.validate_sample)
+    else:
+        transform_class = AggregatedTransform if AGGREGATED else Transform
+        tr = transform_class(films_linked)
+    tr.reformat()
+    registry.inc('etl_docs_built_total', len(tr.elastic_format))
+    return tr
+
+
+def main() -> dict:
     """Основной метод запуска синхронизации.
 
     Запускает остальной функционал в несколько прогонов,
     для обеспечения полноты копирования и распределения нагрузки.
+    В режиме MAIN_PIPELINED извлечение, преобразование и загрузка
+    идут параллельно в потоках, состояние фиксируется так же,
+    после загрузки страницы.
 
-    Имеется защита от повторного запуска скрипта.
+    Имеется защита от повторного запуска скрипта. В режиме воркера
+    (WORKER_PARTITIONS) её роль играет аренда партиций очереди
+    в postgres: воркеры делят очередь, а партиции упавшего
+    забирают остальные, локальный флаг START не проверяется.
+    Пока идёт --full-reindex, прогон пропускается (ReindexLock):
+    этот флаг есть только у процесса, запустившего переиндексацию.
+
+    :return: итоги прогона: документы, время, время по стадиям
     """
     create_elastic_index()
     logger.info('Synchronise of modified records.')
 
-    limit_size = main_conf.limit_size
-
-    n_run = 1  # номер прогона.
     # через парсер для избежания конфликта типов
     start_time = parser().parse('1970-01-01T00:00:00.000Z')
-    last_max_modified = None
 
-    storage = JsonFileStorage(cache_conf.main)
+    storage = get_storage(cache_conf.main)
     state = State(storage)
     global_state = state.get_state('global_state')
-    global_n_run = state.get_state('global_n_run')
+
+    leases = None
+    if worker_conf.partitions:
+        if main_conf.source != 'outbox':
+            raise ValueError('WORKER_PARTITIONS requires MAIN_SOURCE=outbox.')
+        leases = get_leases()
 
     # Защита от повторного запуска, с записью лога уровня warning
-    if global_state == CacheStates.START:
+    if global_state == CacheStates.START and not leases:
         logger.warning('Abort. Previous synch process has not been completed.')
         exit()
 
@@ -73,62 +415,225 @@ def main() -> None:
     else:
         modified_after = start_time
 
-    if global_state == CacheStates.ERROR:
-        n_run = global_n_run
+    # после ошибки продолжаем с курсоров страницы, на которой упали
+    cursors = load_cursors(state, modified_after)
+
+    def commit(checkpoint: Checkpoint) -> None:
+        started = perf_counter()
+        for key, value in checkpoint.values.items():
+            state.set_state(key, value)
+        state.flush()
+        registry.observe('etl_checkpoint_seconds', perf_counter() - started)
+        if checkpoint.callback:
+            checkpoint.callback()
+
+    reindex_lock = get_reindex_lock()
+    if not reindex_lock.acquire_shared():
+        logger.warning('Skip. Full reindex is in progress.')
+        return {'processed': 0, 'skipped': 0, 'elapsed': 0.0, 'stages': {}}
 
     try:
         postgres_saver = PostgresSaver()
         state.set_state('global_state', CacheStates.START)
-        while True:
-            state.set_state('global_state', CacheStates.START)
-            state.set_state('global_n_run', n_run)
-            pp = PostgresProducer(postgres_saver, limit_size,
-                                  modified_after, n_run)
-            pp.collect()
+        state.set_state('cursors', dump_cursors(cursors))
+        state.flush()
 
-            if not pp.has_results:  # событие остановки
-                state.set_state('global_state', CacheStates.FINISH)
-                # дата с предыдущего прогона
-                state.set_state('modified_after', last_max_modified)
-                logger.info('Synchronization completed.')
-                break
+        loader = ElasticsearchLoader()
+        if main_conf.source == 'outbox':
+            extractor = OutboxExtractor(postgres_saver, PostgresSaver(),
+                                        main_conf.limit_size, modified_after,
+                                        leases)
+            if leases:
+                logger.info(f'Worker partitions {sorted(leases.owned)} '
+                            f'of {leases.total}.')
+                registry.set('etl_worker_partitions', len(leases.owned))
+                if leases.gained:
+                    # фильмы новых партиций мог переиндексировать другой
+                    # воркер, локальные дайджесты для них устарели
+                    get_digest_store().clear()
+        else:
+            extractor = Extractor(
+                postgres_saver, main_conf.limit_size, modified_after,
+                cursors, state.get_state('dirty_done') or 0,
+                main_conf.max_dirty,
+                loader if main_conf.partial_updates else None,
+                PostgresOutbox(postgres_saver, PostgresSaver(),
+                               main_conf.limit_size),
+            )
+        pipeline = Pipeline((transform, loader.load_it), commit,
+                            main_conf.queue_size)
+        started = monotonic()
+        if main_conf.pipelined:
+            processed = pipeline.run_pipelined(extractor)
+        else:
+            processed = pipeline.run_sequential(extractor)
+        elapsed = monotonic() - started
 
-            last_max_modified = max_date(last_max_modified,
-                                         pp.max_modified_after)
+        state.set_state('global_state', CacheStates.FINISH)
+        # дата с предыдущего прогона
+        if extractor.last_max_modified:
+            state.set_state('modified_after', extractor.last_max_modified)
+        state.flush()
+        mode = 'pipelined' if main_conf.pipelined else 'sequential'
+        logger.info(f'Synchronization completed. {processed} docs '
+                    f'in {elapsed:.2f}s ({processed / elapsed:.1f} docs/s, '
+                    f'{mode}), {loader.skipped} unchanged skipped.')
 
-            n_run2 = 1
-            while True:
-                pe = PostgresEnricher(pp, limit_size, modified_after, n_run2)
-                pe.collect()
-                if not pe.has_results:  # событие остановки
-                    last_max_modified = max_date(last_max_modified,
-                                                 pe.max_modified_after)
-                    break
+        now = datetime.now(timezone.utc)
+        registry.inc('etl_runs_total', status='success')
+        registry.set('etl_run_seconds', elapsed)
+        registry.set('etl_last_success_timestamp_seconds', now.timestamp())
+        lag = 0.0  # изменений не нашлось - догонять нечего
+        if extractor.last_max_modified:
+            lag = (now - extractor.last_max_modified).total_seconds()
+        registry.set('etl_lag_seconds', lag)
+        return {'processed': processed, 'skipped': loader.skipped,
+                'elapsed': elapsed, 'stages': pipeline.stage_seconds}
+
+    except Exception as e:
+        state.set_state('global_state', CacheStates.ERROR)
+        state.flush()
+        registry.inc('etl_runs_total', status='error')
+        logger.error(f'{e}')
+        raise e
 
-                # если изменить 1 жанр, то изменятся тысячи произведений...
-                # поэтому сразу заливка, небольшими кусками.
-                pm = PostgresMerger(postgres_saver, modified_after,
-                                    pe.results['get_person_links'],
-                                    pe.results['get_genre_links'])
-                pm.collect()
-                last_max_modified = max_date(last_max_modified,
-                                             pm.max_modified_after)
+    finally:
+        reindex_lock.release()
+        write_file()
 
-                tr = Transform(pm.results['get_films_linked'])
-                tr.reformat()
 
-                es = ElasticsearchLoader(tr)
-                es.load_it()
-                n_run2 += 1
-            n_run += 1
+def full_reindex() -> None:
+    """Полная переиндексация в новый индекс с переключением алиаса.
+
+    Индекс movies_<время> создаётся без refresh и реплик и заливается
+    всеми фильмами одним потоковым запросом - на одном снимке базы.
+    Затем настройки схемы возвращаются, сегменты сливаются в один
+    и алиас movies атомарно переключается на новый индекс. До этого
+    момента поиск по movies отвечает из старого индекса.
+
+    Курсоры инкрементальной синхронизации не трогаются: они старше
+    снимка, и правки, сделанные во время переиндексации, она догонит.
+    Для этого прогоны синхронизации всех процессов стоят, пока
+    переиндексация держит ReindexLock: иначе они сдвинули бы курсоры
+    и подтвердили очередь по правкам, записанным в старый индекс.
+    """
+    state = State(get_storage(cache_conf.main))
+    global_state = state.get_state('global_state')
+    if global_state == CacheStates.START:
+        logger.warning('Abort. Previous synch process has not been completed.')
+        exit()
+
+    schema = load_schema()
+    settings = schema['settings']
+    es = get_es_client()
+    digests = get_digest_store()
+    swapped = False
+
+    reindex_lock = get_reindex_lock()
+    logger.info('Waiting for running synchronizations.')
+    reindex_lock.acquire()
+    # всё, что может упасть после захвата, - внутри try с release
+    try:
+        index = f'movies_{datetime.now(timezone.utc):%Y%m%d%H%M%S}'
+        state.set_state('global_state', CacheStates.START)
+        state.flush()
+        logger.info(f'Full reindex into {index}.')
+        es.indices.create(index=index, mappings=schema['mappings'],
+                          settings={**settings, 'refresh_interval': '-1',
+                                    'number_of_replicas': 0})
+        digests.clear()  # дайджесты будут относиться к новому индексу
+        # фильмы собираются с текущими именами, частичные обновления
+        # по старым именам из CACHE_NAMES к ним не подойдут
+        NameStore(cache_conf.names).clear()
+
+        merger = PostgresMerger(
+            PostgresSaver(), parser().parse('1970-01-01T00:00:00.000Z'),
+            None, aggregated=AGGREGATED,
+        )
+        loader = ElasticsearchLoader(digests=digests, index=index)
+        pipeline = Pipeline((transform, loader.load_it),
+                            lambda checkpoint: None, main_conf.queue_size)
+        started = monotonic()
+        if main_conf.pipelined:
+            processed = pipeline.run_pipelined(merger.iter_films_linked())
+        else:
+            processed = pipeline.run_sequential(merger.iter_films_linked())
+        elapsed = monotonic() - started
+        logger.info(f'Loaded {processed} docs in {elapsed:.2f}s '
+                    f'({processed / elapsed:.1f} docs/s).')
+
+        # None возвращает значение по умолчанию
+        es.indices.put_settings(index=index, settings={
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas'),
+        })
+        es.indices.refresh(index=index)
+        es.options(request_timeout=3600).indices.forcemerge(
+            index=index, max_num_segments=1,
+        )
+        previous_indices = swap_alias(es, 'movies', index)
+        swapped = True
+        logger.info(f'Alias movies switched to {index}.')
+        for previous in previous_indices:
+            es.indices.delete(index=previous)
+
+        state.set_state('global_state', global_state or CacheStates.FINISH)
+        state.flush()
 
     except Exception as e:
+        if not swapped:
+            # новый индекс брошен, старому дайджесты не соответствуют
+            digests.clear()
+            es.indices.delete(index=index, ignore_unavailable=True)
         state.set_state('global_state', CacheStates.ERROR)
+        state.flush()
         logger.error(f'{e}')
         raise e
 
+    finally:
+        reindex_lock.release()
 
-if __name__ == '__main__':
+
+def daemon() -> None:
+    """Долгоживущий режим: синхронизация по уведомлениям postgres.
+
+    Просыпается по NOTIFY от триггера очереди изменений, ещё
+    MAIN_DEBOUNCE секунд склеивает всплеск правок в один прогон
+    и запускает main(). Если уведомлений нет MAIN_POLL_INTERVAL секунд,
+    синхронизирует по таймеру - на случай, если они перестали приходить.
+    """
+    listener = PostgresListener(OUTBOX_CHANNEL)
+    main()  # то, что накопилось до подписки
     while True:
+        if listener.wait(main_conf.poll_interval):
+            deadline = monotonic() + main_conf.debounce
+            while listener.wait(max(deadline - monotonic(), 0)):
+                pass
+        else:
+            logger.info('No notifications, polling.')
         main()
-        sleep(main_conf.sleep_period)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Синхронизация фильмов postgres -> elasticsearch.'
+    )
+    arg_parser.add_argument(
+        '--daemon', action='store_true',
+        help='ждать изменений через LISTEN/NOTIFY вместо цикла со sleep',
+    )
+    arg_parser.add_argument(
+        '--full-reindex', action='store_true',
+        help='пересобрать индекс целиком и переключить на него алиас movies',
+    )
+    args = arg_parser.parse_args()
+    start_http_server()
+
+    if args.full_reindex:
+        full_reindex()
+    elif args.daemon:
+        daemon()
+    else:
+        while True:
+            main()
+            sleep(main_conf.sleep_period)
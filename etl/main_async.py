@@ -0,0 +1,259 @@
+"""Асинхронный вариант ETL.
+
+Та же синхронизация, что и в main.py, но на psycopg 3 и AsyncElasticsearch:
+выборки страниц связей и bulk-запросы предыдущих страниц идут
+одновременно (до ASYNC_CONCURRENCY страниц в загрузке) в одном процессе.
+Состояние (курсоры продюсера) общее с main.py, движки взаимозаменяемы.
+"""
+import asyncio
+from datetime import datetime, timezone
+from time import monotonic, sleep
+from typing import Optional
+
+from dateutil.parser import parser
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_bulk
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+
+import queries
+from config import AsyncConf, CacheConf, ElasticConf, MainConf
+from elasticsearch_loader import get_digest_store, iter_actions
+from lib import CacheStates, NameStore, State, get_logger, get_storage
+from main import (AGGREGATED, create_elastic_index, dump_cursors,
+                  get_reindex_lock, load_cursors, max_date, transform)
+from postgres_operations import (Cursor, PostgresEnricher, PostgresMixin,
+                                 PostgresProducer, advance_cursors)
+from postgres_saver import get_dsl
+
+logger = get_logger('etl module')
+main_conf, cache_conf, elastic_conf = MainConf(), CacheConf(), ElasticConf()
+async_conf = AsyncConf()
+
+producer_tables = {'person': 'person', 'genre': 'genre',
+                   'filmwork': 'film_work'}
+link_streams = PostgresEnricher.streams
+link_tables = {'person_links': ('person_film_work', 'person_id'),
+               'genre_links': ('genre_film_work', 'genre_id')}
+
+
+class AsyncSync:
+    """Один прогон синхронизации поверх пула соединений и клиента ES."""
+    last_max_modified: Optional[datetime]
+    processed: int
+
+    def __init__(self,
+                 pool: AsyncConnectionPool,
+                 es: AsyncElasticsearch,
+                 limit_size: int,
+                 concurrency: int) -> None:
+        self.pool = pool
+        self.es = es
+        self.limit_size = limit_size
+        self.concurrency = concurrency
+        self.last_max_modified = None
+        self.processed = 0
+
+    async def fetch(self, query: str, params: Optional[tuple] = None) -> list:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=dict_row) as cursor:
+                await cursor.execute(query, params, prepare=True)
+                return await cursor.fetchall()
+
+    async def write(self, query: str, params: Optional[tuple] = None) -> None:
+        """Изменяющий запрос, фиксируется при возврате соединения."""
+        async with self.pool.connection() as conn:
+            await conn.execute(query, params)
+
+    def track(self, rows: list) -> None:
+        """Обновляет максимальный modified прогона."""
+        if rows:
+            self.last_max_modified = max_date(
+                self.last_max_modified, PostgresMixin.get_max_modified(rows)
+            )
+
+    async def producer_page(self, cursors: dict[str, Cursor]) -> dict:
+        """Страницы всех потоков продюсера, запросы идут параллельно."""
+        pages = await asyncio.gather(*(
+            self.fetch(queries.changed_page(producer_tables[stream],
+                                            self.limit_size),
+                       (cursors[stream].modified, str(cursors[stream].id)))
+            for stream in PostgresProducer.streams
+        ))
+        return dict(zip(PostgresProducer.streams, pages))
+
+    async def links_page(self,
+                         link_table: str,
+                         link_column: str,
+                         uuids: list,
+                         cursor: Cursor) -> list:
+        """Фильмы, связанные с uuids, после курсора (modified, id)."""
+        if not uuids:
+            return []
+        return await self.fetch(
+            queries.linked_films_after(link_table, link_column,
+                                       self.limit_size),
+            (queries.uuid_array(uuids), cursor.modified, str(cursor.id)),
+        )
+
+    async def sync_films(self, films_uuid: set) -> None:
+        """Фильмы -> Transform -> bulk."""
+        films_query = queries.films_aggregated if AGGREGATED \
+            else queries.films_linked
+        films_linked = await self.fetch(
+            films_query(), (queries.uuid_array(films_uuid),)
+        )
+        self.track(films_linked)
+        tr = await asyncio.to_thread(transform, films_linked)
+        await async_bulk(self.es, iter_actions(tr),
+                         chunk_size=elastic_conf.chunk_size,
+                         max_chunk_bytes=elastic_conf.max_chunk_bytes,
+                         max_retries=elastic_conf.max_retries,
+                         initial_backoff=elastic_conf.initial_backoff,
+                         max_backoff=elastic_conf.max_backoff)
+        if elastic_conf.skip_unchanged:
+            # дайджесты здесь не считаются, а старые уже неверны
+            await asyncio.to_thread(get_digest_store().discard,
+                                    tr.elastic_format)
+        self.processed += len(tr.elastic_format)
+
+    async def sync_page(self, pages: dict) -> None:
+        """Фильмы одной страницы продюсера.
+
+        Изменённые напрямую фильмы (страница filmwork) собираются
+        вместе с первой страницей связей, одним набором id, как
+        в main.Extractor. Страницы связей идут keyset-курсорами
+        (modified, id), свой на персон и на жанры, как в PostgresEnricher:
+        следующая страница выбирается, пока грузятся предыдущие,
+        в загрузке - до concurrency страниц.
+        """
+        uuids = {stream: [row['id'] for row in pages[kind]]
+                 for stream, kind in zip(link_streams, ('person', 'genre'))}
+        start = Cursor(modified=datetime.min.replace(tzinfo=timezone.utc))
+        cursors = dict.fromkeys(link_streams, start)
+        films_uuid = {row['id'] for row in pages['filmwork']}
+        loading = set()
+        try:
+            while True:
+                links = dict(zip(link_streams, await asyncio.gather(*(
+                    self.links_page(*link_tables[stream], uuids[stream],
+                                    cursors[stream])
+                    for stream in link_streams
+                ))))
+                for stream, page in links.items():
+                    self.track(page)
+                    films_uuid.update(row['id'] for row in page)
+                    if len(page) < self.limit_size:  # связи закончились
+                        uuids[stream] = []
+                if films_uuid:
+                    if len(loading) >= self.concurrency:
+                        done, loading = await asyncio.wait(
+                            loading, return_when=asyncio.FIRST_COMPLETED,
+                        )
+                        for task in done:
+                            task.result()
+                    loading.add(asyncio.create_task(
+                        self.sync_films(films_uuid)
+                    ))
+                    films_uuid = set()
+                if not any(uuids.values()):
+                    break
+                cursors = advance_cursors(cursors, links)
+            await asyncio.gather(*loading)
+        except BaseException:
+            for task in loading:
+                task.cancel()
+            raise
+
+
+async def main() -> None:
+    """Асинхронный прогон синхронизации.
+
+    Состояние фиксируется после загрузки каждой страницы продюсера,
+    как и в main.main. Защита от повторного запуска общая.
+    Очередь content.film_work_outbox движку не нужна: после каждой
+    страницы из неё удаляются строки, записанные до начала страницы.
+    Фильмы переименованных персон и жанров собираются целиком,
+    поэтому их имена в CACHE_NAMES забываются: для main.py они снова
+    неизвестны, а не переименованы.
+    """
+    create_elastic_index()
+    logger.info('Synchronise of modified records (async).')
+
+    state = State(get_storage(cache_conf.main))
+    if state.get_state('global_state') == CacheStates.START:
+        logger.warning('Abort. Previous synch process has not been completed.')
+        exit()
+
+    cached_modified = state.get_state('modified_after')
+    if cached_modified:
+        modified_after = parser().parse(cached_modified)
+    else:
+        modified_after = parser().parse('1970-01-01T00:00:00.000Z')
+    cursors = load_cursors(state, modified_after)
+    names = NameStore(cache_conf.names)
+
+    reindex_lock = get_reindex_lock()
+    if not reindex_lock.acquire_shared():
+        logger.warning('Skip. Full reindex is in progress.')
+        return
+
+    try:
+        state.set_state('global_state', CacheStates.START)
+        state.set_state('cursors', dump_cursors(cursors))
+        state.flush()
+        es = AsyncElasticsearch(hosts=elastic_conf.hosts)
+        started = monotonic()
+        try:
+            async with AsyncConnectionPool(
+                    kwargs=get_dsl(), min_size=1,
+                    max_size=async_conf.pool_size, open=False,
+            ) as pool:
+                sync = AsyncSync(pool, es, main_conf.limit_size,
+                                 async_conf.concurrency)
+                while True:
+                    outbox_id = (await sync.fetch(
+                        queries.outbox_max_id()))[0]['id']
+                    pages = await sync.producer_page(cursors)
+                    if not any(pages.values()):  # событие остановки
+                        await sync.write(queries.outbox_prune(),
+                                         (outbox_id,))
+                        break
+                    sync.track([row for page in pages.values()
+                                for row in page])
+                    await sync.sync_page(pages)
+                    for kind in ('person', 'genre'):
+                        await asyncio.to_thread(
+                            names.discard, kind,
+                            [row['id'] for row in pages[kind]],
+                        )
+                    cursors = advance_cursors(cursors, pages)
+                    state.set_state('cursors', dump_cursors(cursors))
+                    state.flush()
+                    await sync.write(queries.outbox_prune(), (outbox_id,))
+        finally:
+            await es.close()
+        elapsed = monotonic() - started
+
+        state.set_state('global_state', CacheStates.FINISH)
+        if sync.last_max_modified:
+            state.set_state('modified_after', sync.last_max_modified)
+        state.flush()
+        logger.info(f'Synchronization completed. {sync.processed} docs '
+                    f'in {elapsed:.2f}s '
+                    f'({sync.processed / elapsed:.1f} docs/s, async).')
+
+    except Exception as e:
+        state.set_state('global_state', CacheStates.ERROR)
+        state.flush()
+        logger.error(f'{e}')
+        raise e
+
+    finally:
+        reindex_lock.release()
+
+
+if __name__ == '__main__':
+    while True:
+        asyncio.run(main())
+        sleep(main_conf.sleep_period)
@@ -0,0 +1,170 @@
+"""Метрики ETL в текстовом формате Prometheus.
+
+Счётчики и время копятся в процессе (registry) и отдаются
+файлом для textfile-коллектора (METRICS_FILE) и/или по HTTP
+на /metrics (METRICS_PORT).
+"""
+import os
+import tempfile
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Iterable, Iterator, Optional
+
+from config import MetricsConf
+
+metrics_conf = MetricsConf()
+
+HELP = {
+    'etl_rows_fetched_total': 'Rows read from postgres.',
+    'etl_query_seconds': 'Time spent in postgres queries.',
+    'etl_docs_built_total': 'Documents built by Transform.',
+    'etl_docs_indexed_total': 'Documents accepted by elasticsearch.',
+    'etl_docs_skipped_total': 'Unchanged documents not sent.',
+    'etl_docs_patched_total': 'Documents updated in place.',
+    'etl_bulk_errors_total': 'Documents rejected by elasticsearch.',
+    'etl_docs_dead_lettered_total': 'Permanently rejected documents '
+                                    'skipped and saved for review.',
+    'etl_bulk_retries_total': 'Temporarily rejected documents sent again.',
+    'etl_bulk_chunk_size': 'Current adaptive bulk chunk size.',
+    'etl_bulk_concurrency': 'Current adaptive number of parallel bulks.',
+    'etl_stage_seconds': 'Time spent in a pipeline stage.',
+    'etl_checkpoint_seconds': 'Time spent writing checkpoints.',
+    'etl_runs_total': 'Synchronization runs.',
+    'etl_run_seconds': 'Duration of the last run.',
+    'etl_lag_seconds': 'Now minus the newest modified seen by the last '
+                       'run, 0 if it found no changes.',
+    'etl_last_success_timestamp_seconds': 'End of the last successful run.',
+    'etl_worker_partitions': 'Outbox partitions leased by this worker.',
+}
+
+
+class Registry:
+    """Счётчики, значения и суммы времени с метками.
+
+    Метки - именованные аргументы. Время (observe) хранится как
+    summary без квантилей: _sum и _count.
+    """
+
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.counters: dict[tuple, float] = {}
+        self.gauges: dict[tuple, float] = {}
+        self.summaries: dict[tuple, list[float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = self._key(name, labels)
+        with self.lock:
+            total = self.summaries.setdefault(key, [0.0, 0])
+            total[0] += seconds
+            total[1] += 1
+
+    def timed(self, iterable: Iterable, name: str, **labels) -> Iterator:
+        """Итерация с учётом времени, потраченного внутри next()."""
+        iterator = iter(iterable)
+        while True:
+            started = perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.observe(name, perf_counter() - started, **labels)
+            yield item
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus."""
+        families: dict[str, tuple[str, list[str]]] = {}
+        with self.lock:
+            for kind, values in (('counter', self.counters),
+                                 ('gauge', self.gauges)):
+                for (name, labels), value in sorted(values.items()):
+                    samples = families.setdefault(name, (kind, []))[1]
+                    samples.append(f'{name}{_labels(labels)} {value}')
+            for (name, labels), (total, count) in \
+                    sorted(self.summaries.items()):
+                samples = families.setdefault(name, ('summary', []))[1]
+                samples.append(f'{name}_sum{_labels(labels)} {total}')
+                samples.append(f'{name}_count{_labels(labels)} {count}')
+
+        lines = []
+        for name, (kind, samples) in families.items():
+            lines.append(f'# HELP {name} {HELP.get(name, name)}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{label}="{_escape(value)}"'
+                          for label, value in labels) + '}'
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+registry = Registry()
+
+
+def write_file(path: Optional[str] = None) -> None:
+    """Атомарная запись метрик в файл, если он задан."""
+    path = path or metrics_conf.file
+    if not path:
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    try:
+        with os.fdopen(fd, 'w') as file_:
+            file_.write(registry.render())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args) -> None:
+        pass  # запросы скрейпера в лог ETL не пишем
+
+    def do_GET(self) -> None:
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_http_server(port: Optional[int] = None) -> Optional[Thread]:
+    """/metrics в фоновом потоке, если задан порт."""
+    port = port if port is not None else metrics_conf.port
+    if not port:
+        return None
+    server = ThreadingHTTPServer((metrics_conf.host, port), _Handler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever, name='metrics',
+                    daemon=True)
+    thread.start()
+    return thread
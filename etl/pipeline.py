@@ -0,0 +1,187 @@
+from dataclasses import dataclass, field
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from time import perf_counter
+from typing import Any, Callable, Iterable, Iterator, Optional, Sequence
+
+from metrics import registry
+
+_DONE = object()  # конец потока пачек
+_POLL_TIMEOUT = 0.1  # как часто ждущий поток проверяет сигнал остановки
+
+
+class _Stopped(Exception):
+    """Конвейер остановлен из-за ошибки в другом потоке."""
+
+
+@dataclass
+class Checkpoint:
+    """Маркер в потоке пачек.
+
+    Значения состояния, которые можно зафиксировать,
+    когда все пачки перед маркером загружены, и действие,
+    которое тогда же нужно выполнить (например, подтвердить очередь).
+
+    barrier - источник продолжит, только когда маркер зафиксирован:
+    то, что он сделает дальше, не обгонит уже отданные пачки.
+    """
+    values: dict
+    callback: Optional[Callable[[], None]] = None
+    barrier: bool = False
+    committed: Event = field(default_factory=Event, repr=False,
+                             compare=False)
+
+
+class Pipeline:
+    """Прогон пачек через стадии extract -> transform -> load.
+
+    Стадия - функция над пачкой, последняя возвращает число
+    обработанных документов. Checkpoint проходит стадии без изменений
+    и передаётся в commit после последней стадии, поэтому состояние
+    фиксируется только после загрузки всех пачек до маркера.
+
+    stage_seconds - время в каждой стадии (extract - в источнике,
+    commit - в фиксации состояния), без ожидания в очередях.
+    """
+    processed: int
+    stage_seconds: dict[str, float]
+
+    def __init__(self,
+                 stages: Sequence[Callable[[Any], Any]],
+                 commit: Callable[[Checkpoint], None],
+                 queue_size: int = 4) -> None:
+        self.stages = stages
+        self.commit = commit
+        self.queue_size = queue_size
+        self.processed = 0
+        self.stage_seconds = {}
+
+    @staticmethod
+    def stage_name(stage: Callable) -> str:
+        return getattr(stage, '__name__', 'stage')
+
+    def _timed(self, name: str, func: Callable, *args) -> Any:
+        started = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = perf_counter() - started
+            # у каждой стадии свой ключ, потоки друг другу не мешают
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) \
+                + elapsed
+            registry.observe('etl_stage_seconds', elapsed, stage=name)
+
+    def _timed_source(self, source: Iterable) -> Iterator:
+        iterator = iter(source)
+        while True:
+            try:
+                yield self._timed('extract', next, iterator)
+            except StopIteration:
+                return
+
+    def _sink(self, item: Any) -> None:
+        if isinstance(item, Checkpoint):
+            self._timed('commit', self.commit, item)
+            item.committed.set()
+        else:
+            self.processed += item
+
+    def run_sequential(self, source: Iterable) -> int:
+        """Все стадии по очереди в текущем потоке."""
+        self.processed = 0
+        self.stage_seconds = {}
+        for item in self._timed_source(source):
+            for stage in self.stages:
+                if isinstance(item, Checkpoint):
+                    break
+                item = self._timed(self.stage_name(stage), stage, item)
+            self._sink(item)
+        return self.processed
+
+    def run_pipelined(self, source: Iterable) -> int:
+        """Извлечение и каждая стадия - в своём потоке.
+
+        Потоки связаны очередями размера queue_size: быстрая стадия
+        ждёт на put, пока медленная не разберёт очередь (backpressure).
+        Ошибка любой стадии останавливает остальные
+        и пробрасывается в вызывающий поток. После Checkpoint
+        с barrier источник ждёт, пока конвейер не опустеет до маркера.
+        """
+        self.processed = 0
+        self.stage_seconds = {}
+        stop = Event()
+        errors: list[BaseException] = []
+        queues = [Queue(maxsize=self.queue_size) for _ in self.stages]
+
+        def guarded(target: Callable, *args) -> Callable[[], None]:
+            def run() -> None:
+                try:
+                    target(*args)
+                except _Stopped:
+                    pass
+                except BaseException as exc:
+                    errors.append(exc)
+                    stop.set()
+            return run
+
+        def feed() -> None:
+            for item in self._timed_source(source):
+                self._put(queues[0], item, stop)
+                if isinstance(item, Checkpoint) and item.barrier:
+                    self._wait(item.committed, stop)
+            self._put(queues[0], _DONE, stop)
+
+        def work(stage: Callable, inbox: Queue, outbox: Queue) -> None:
+            for item in self._drain(inbox, stop):
+                if not isinstance(item, Checkpoint):
+                    item = self._timed(self.stage_name(stage), stage, item)
+                if outbox is None:
+                    self._sink(item)
+                else:
+                    self._put(outbox, item, stop)
+            if outbox is not None:
+                self._put(outbox, _DONE, stop)
+
+        outboxes = queues[1:] + [None]
+        threads = [Thread(target=guarded(feed), name='extract', daemon=True)]
+        threads += [
+            Thread(target=guarded(work, stage, inbox, outbox),
+                   name=self.stage_name(stage), daemon=True)
+            for stage, inbox, outbox in zip(self.stages, queues, outboxes)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return self.processed
+
+    @staticmethod
+    def _put(queue: Queue, item: Any, stop: Event) -> None:
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=_POLL_TIMEOUT)
+                return
+            except Full:
+                continue
+        raise _Stopped
+
+    @staticmethod
+    def _wait(event: Event, stop: Event) -> None:
+        while not event.wait(_POLL_TIMEOUT):
+            if stop.is_set():
+                raise _Stopped
+
+    @staticmethod
+    def _drain(queue: Queue, stop: Event) -> Iterator:
+        while True:
+            try:
+                item = queue.get(timeout=_POLL_TIMEOUT)
+            except Empty:
+                if stop.is_set():
+                    raise _Stopped
+                continue
+            if item is _DONE:
+                return
+            yield item
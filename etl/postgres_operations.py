@@ -1,21 +1,30 @@
 import abc
-from datetime import datetime
+from datetime import datetime, timezone
 from functools import wraps
-from typing import Optional
+from time import perf_counter
+from typing import Any, Iterable, Iterator, Optional, Union
+from uuid import UUID
 
-from dateutil.parser import parser
+from pydantic import BaseModel
 
+import queries
 from config import CacheConf
-from lib import CacheStates, JsonFileStorage, State
+from lib import CacheStates, NameStore, RowBatch, State, get_storage
+from metrics import registry
 from postgres_saver import PostgresSaver
 
 cache_conf = CacheConf()
 
+# канал NOTIFY, в который пишет триггер очереди (миграция movies_admin 0004)
+OUTBOX_CHANNEL = 'film_work_outbox'
+
 
 def write_operations_state():
     """Декоратор сохранения состояние метода класса и его результата.
 
     Формат имени - имя_класса.имя_метода.ключ .
+    На диск состояние уходит один раз, когда метод закончен.
+    Результат - RowBatch, он хранится в упакованном виде (RowBatch.pack).
     """
     def func_wrapper(func):
         @wraps(func)
@@ -31,8 +40,9 @@ def write_operations_state():
             )
             self.state.set_state(
                 f'{self.__class__.__name__}.{func.__name__}.result',
-                result
+                result.pack()
             )
+            self.state.flush()
             return result
         return inner
     return func_wrapper
@@ -40,32 +50,47 @@ def write_operations_state():
 
 class PostgresMixin(abc.ABC):
     """Общий код классов работы с базой."""
+    postgres_saver: PostgresSaver
     max_modified_after: Optional[datetime]
     modified_after: Optional[datetime]
     has_results: bool
     path: str
+    stage: str  # метка в метриках
     results: dict
 
     def __init__(self, modified_after: datetime) -> None:
-        self.storage = JsonFileStorage(self.path)
+        self.storage = get_storage(self.path)
         self.state = State(self.storage)
         self.results = {}
         self.has_results = False
 
         self.modified_after = self.max_modified_after = modified_after
 
+    def fetch_batch(self,
+                    query: str,
+                    params: Optional[tuple] = None) -> RowBatch:
+        """Страница (id, modified) запроса колонками (queries.columns).
+
+        Запрос подготовленный: текст страницы один и тот же, меняются
+        только параметры.
+        """
+        started = perf_counter()
+        row, = self.postgres_saver.execute_prepared(queries.columns(query),
+                                                    params)
+        registry.observe('etl_query_seconds', perf_counter() - started,
+                         stage=self.stage)
+        batch = RowBatch.from_row(row)
+        registry.inc('etl_rows_fetched_total', len(batch), stage=self.stage)
+        return batch
+
     @staticmethod
-    def get_max_modified(ready_result: dict) -> datetime:
+    def get_max_modified(ready_result: Union[list, RowBatch]) -> datetime:
         """Возвращает максимальное время для поля modified"""
-        a = []
-        for res in ready_result:
-            if isinstance(res['modified'], datetime):
-                a.append(res['modified'])
-            else:
-                a.append(parser().parse(res['modified']))
-        return max(a)
+        if isinstance(ready_result, RowBatch):
+            return ready_result.max_modified()
+        return max(row['modified'] for row in ready_result)
 
-    def analyze_result(self, result: dict) -> None:
+    def analyze_result(self, result: Union[list, RowBatch]) -> None:
         """Определяем есть результат сбора и обновляем максимальную дату"""
         if len(result) > 0:
             self.has_results = True
@@ -76,6 +101,10 @@ class PostgresMixin(abc.ABC):
             if max_modified > self.max_modified_after \
             else self.max_modified_after
 
+    def page_key(self) -> Any:
+        """Идентификатор страницы, к которой относится кэш результатов."""
+        return None
+
     @abc.abstractmethod
     def _collect_methods(self) -> tuple:
         """Возвращает кортеж методов для выполнения collect"""
@@ -96,9 +125,14 @@ class PostgresMixin(abc.ABC):
         found_broken = False  # нашли на каком методе вывалилось выполнение
 
         global_state = self.state.get_state(f'{self.__class__.__name__}')
-        if global_state == CacheStates.START:  # значит вывалились в процессе
+        cached_key = self.state.get_state(f'{self.__class__.__name__}.key')
+        # кэш годится только для той же страницы: в конвейерном режиме
+        # извлечение уходит вперёд загрузки, и упасть можно на другой странице
+        if global_state == CacheStates.START and \
+                cached_key == self.page_key():  # значит вывалились в процессе
             is_broken = True
 
+        self.state.set_state(f'{self.__class__.__name__}.key', self.page_key())
         self.state.set_state(f'{self.__class__.__name__}', CacheStates.START)
 
         for method in get_methods:
@@ -117,12 +151,35 @@ class PostgresMixin(abc.ABC):
                 self.analyze_result(self.results[method.__name__])
                 continue
 
-            self.results[method.__name__] = self.state.get_state(
-                f'{self.__class__.__name__}.{method.__name__}.result'
+            self.results[method.__name__] = RowBatch.unpack(
+                self.state.get_state(
+                    f'{self.__class__.__name__}.{method.__name__}.result'
+                )
             )
             self.analyze_result(self.results[method.__name__])
 
         self.state.set_state(f'{self.__class__.__name__}', CacheStates.FINISH)
+        self.state.flush()
+
+
+class Cursor(BaseModel):
+    """Позиция keyset-пагинации: (modified, id) последней прочитанной строки.
+
+    Пара уникальна, поэтому строки с одинаковым modified
+    не теряются и не повторяются на границе страниц.
+    """
+    modified: datetime
+    id: UUID = UUID(int=0)
+
+
+def advance_cursors(cursors: dict[str, Cursor],
+                    pages: dict[str, list]) -> dict[str, Cursor]:
+    """Сдвигает курсор каждого потока на последнюю строку его страницы."""
+    cursors = dict(cursors)
+    for stream, page in pages.items():
+        if page:
+            cursors[stream] = Cursor.model_validate(page[-1])
+    return cursors
 
 
 class PostgresProducer(PostgresMixin):
@@ -131,163 +188,342 @@ class PostgresProducer(PostgresMixin):
     limit_size: int
     modified_after: datetime
     max_modified_after: Optional[datetime]
-    n_run: int
+    cursors: dict[str, Cursor]
 
     path: str = cache_conf.producer
+    stage: str = 'producer'
+    streams: tuple = ('person', 'genre', 'filmwork')  # порядок как в collect
 
     def __init__(self,
                  postgres_saver: PostgresSaver,
                  limit_size: int,
                  modified_after: datetime,
-                 n_run: int) -> None:
+                 cursors: dict[str, Cursor]) -> None:
         super().__init__(modified_after)
         self.postgres_saver = postgres_saver
         self.limit_size = limit_size
+        self.cursors = cursors
 
-        self.n_run = n_run
-        self.offset_size = limit_size * (n_run - 1)
+    def _get_page(self, table: str, stream: str) -> RowBatch:
+        """Страница изменённых строк таблицы, следующая за курсором потока.
 
-    @write_operations_state()
-    def get_person(self) -> list:
-        query = f"""
-            SELECT id, modified
-            FROM content.person
-            WHERE modified > '{self.modified_after}'
-            ORDER BY modified
-            LIMIT {self.limit_size} OFFSET {self.offset_size};"""
-        result = self.postgres_saver.execute(query)
+        Стоимость не зависит от глубины синхронизации, в отличие от OFFSET.
+        """
+        cursor = self.cursors[stream]
+        query = queries.changed_page(table, self.limit_size)
+        result = self.fetch_batch(query, (cursor.modified, str(cursor.id)))
         return result
 
     @write_operations_state()
-    def get_genre(self) -> list:
-        query = f"""
-            SELECT id, modified
-            FROM content.genre
-            WHERE modified > '{self.modified_after}'
-            ORDER BY modified
-            LIMIT {self.limit_size} OFFSET {self.offset_size};"""
-        result = self.postgres_saver.execute(query)
-        return result
+    def get_person(self) -> RowBatch:
+        return self._get_page('person', 'person')
 
     @write_operations_state()
-    def get_filmwork(self) -> list:
-        query = f"""
-            SELECT id, modified
-            FROM content.film_work
-            WHERE modified > '{self.modified_after}'
-            ORDER BY modified
-            LIMIT {self.limit_size} OFFSET {self.offset_size};"""
-        result = self.postgres_saver.execute(query)
-        return result
+    def get_genre(self) -> RowBatch:
+        return self._get_page('genre', 'genre')
+
+    @write_operations_state()
+    def get_filmwork(self) -> RowBatch:
+        return self._get_page('film_work', 'filmwork')
 
     def _collect_methods(self) -> tuple:
         return self.get_person, self.get_genre, self.get_filmwork
 
+    def page_key(self) -> Any:
+        return {stream: cursor.model_dump(mode='json')
+                for stream, cursor in self.cursors.items()}
+
+    def next_cursors(self) -> dict[str, Cursor]:
+        """Курсоры, с которых начнётся следующая страница."""
+        pages = {stream: self.results.get(method.__name__)
+                 for stream, method
+                 in zip(self.streams, self._collect_methods())}
+        return advance_cursors(self.cursors, pages)
+
 
 class PostgresEnricher(PostgresMixin):
-    """Дополняет инфу по фильмам, инфой о актёрах и жанрах"""
+    """Дополняет инфу по фильмам, инфой о актёрах и жанрах.
+
+    Страницы связей идут keyset-курсорами (modified, id) фильма,
+    свой на персон и на жанры: при возобновлении страница
+    с тем же курсором - та же страница, а не сдвинутый OFFSET.
+    """
     limit_size: int
     path: str = cache_conf.enricher
+    stage: str = 'enricher'
+    streams: tuple = ('person_links', 'genre_links')  # как в collect
 
     def __init__(self,
                  ready_producer: PostgresProducer,
                  limit_size: int,
                  modified_after: datetime,
-                 n: int) -> None:
+                 cursors: Optional[dict[str, Cursor]] = None,
+                 persons_uuid: Optional[list] = None,
+                 genres_uuid: Optional[list] = None) -> None:
         super().__init__(modified_after)
         self.ready_producer = ready_producer
         self.postgres_saver = ready_producer.postgres_saver
-        self.all_persons_uuid = list(map(lambda x: x['id'],
-                                         ready_producer.results['get_person']))
-        self.all_genres_uuid = list(map(lambda x: x['id'],
-                                        ready_producer.results['get_genre']))
+        # явные списки - если связи нужны не всем персонам и жанрам
+        # страницы продюсера (переименованным хватит частичной правки)
+        if persons_uuid is None:
+            persons_uuid = ready_producer.results['get_person'].id_list()
+        if genres_uuid is None:
+            genres_uuid = ready_producer.results['get_genre'].id_list()
+        self.all_persons_uuid = persons_uuid
+        self.all_genres_uuid = genres_uuid
 
         self.limit_size = limit_size
-        self.n = n
-        self.offset_size = limit_size * (n - 1)
+        # первая страница - с самого начала
+        start = Cursor(modified=datetime.min.replace(tzinfo=timezone.utc))
+        self.cursors = cursors or dict.fromkeys(self.streams, start)
+
+    def _get_links(self, stream: str, link_table: str, link_column: str,
+                   uuids: list) -> RowBatch:
+        if not uuids:
+            return RowBatch()
+        cursor = self.cursors[stream]
+        query = queries.linked_films_after(link_table, link_column,
+                                           self.limit_size)
+        return self.fetch_batch(query, (queries.uuid_array(uuids),
+                                        cursor.modified, str(cursor.id)))
 
     @write_operations_state()
-    def get_person_links(self) -> list:
-        if not self.all_persons_uuid:
-            return []
-        all_uuid_str = ','.join(map(lambda x: f"'{x}'",
-                                    self.all_persons_uuid))
-        query = f"""
-        SELECT fw.id, fw.modified
-        FROM content.film_work fw
-        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-        WHERE pfw.person_id IN ({all_uuid_str})
-        ORDER BY fw.modified
-        LIMIT {self.limit_size} OFFSET {self.offset_size}
-        ;"""
-        result = self.postgres_saver.execute(query)
-        return result
+    def get_person_links(self) -> RowBatch:
+        return self._get_links('person_links', 'person_film_work',
+                               'person_id', self.all_persons_uuid)
 
     @write_operations_state()
-    def get_genre_links(self) -> list:
-        if not self.all_genres_uuid:
-            return []
-        all_uuid_str = ','.join(map(lambda x: f"'{x}'",
-                                    self.all_genres_uuid))
-        query = f"""
-        SELECT fw.id, fw.modified
-        FROM content.film_work fw
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        WHERE gfw.genre_id IN ({all_uuid_str})
-        ORDER BY fw.modified
-        LIMIT {self.limit_size} OFFSET {self.offset_size}
-        ;"""
-        result = self.postgres_saver.execute(query)
-        return result
+    def get_genre_links(self) -> RowBatch:
+        return self._get_links('genre_links', 'genre_film_work',
+                               'genre_id', self.all_genres_uuid)
 
     def _collect_methods(self) -> tuple:
         return self.get_person_links, self.get_genre_links
 
+    def next_cursors(self) -> dict[str, Cursor]:
+        """Курсоры следующей страницы связей."""
+        pages = {stream: self.results.get(method.__name__)
+                 for stream, method
+                 in zip(self.streams, self._collect_methods())}
+        return advance_cursors(self.cursors, pages)
+
+    def page_key(self) -> Any:
+        return [self.ready_producer.page_key(),
+                {stream: cursor.model_dump(mode='json')
+                 for stream, cursor in self.cursors.items()},
+                [str(id_) for id_ in self.all_persons_uuid],
+                [str(id_) for id_ in self.all_genres_uuid]]
+
 
 class PostgresMerger(PostgresMixin):
+    """Собирает фильмы целиком: с персонами и жанрами.
 
+    В режиме aggregated массивы собирает postgres,
+    и на каждый фильм приходит ровно одна строка.
+    films_uuid=None - все фильмы одним запросом, то есть
+    на одном снимке базы (полная переиндексация).
+    """
     path: str = cache_conf.merger
+    stage: str = 'merger'
 
     def __init__(self,
                  postgres_saver: PostgresSaver,
                  modified_after: datetime,
-                 genre_results: dict,
-                 person_results: dict):
+                 films_uuid: Optional[Iterable],
+                 aggregated: bool = False):
         super().__init__(modified_after)
         self.postgres_saver = postgres_saver
-        self.genre_results = genre_results
-        self.person_results = person_results
+        self.films_uuid = None if films_uuid is None else set(films_uuid)
+        self.aggregated = aggregated
 
-    @write_operations_state()
-    def get_films_linked(self) -> list:
-        films_via_genre = list(map(lambda x: x['id'], self.genre_results))
-        films_via_person = list(map(lambda x: x['id'], self.person_results))
-        films_uuid = set(films_via_genre + films_via_person)
-        if not films_uuid:
-            return []
-
-        all_uuid_str = ','.join(map(lambda x: f"'{x}'", films_uuid))
-        query = f"""
-        SELECT
-            fw.id as fw_id,
-            fw.title,
-            fw.description,
-            fw.rating,
-            fw.type,
-            fw.created,
-            fw.modified,
-            pfw.role,
-            p.id,
-            p.full_name,
-            g.name
-        FROM content.film_work fw
-        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
-        LEFT JOIN content.person p ON p.id = pfw.person_id
-        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
-        LEFT JOIN content.genre g ON g.id = gfw.genre_id
-        WHERE fw.id IN ({all_uuid_str});"""
-        result = self.postgres_saver.execute(query)
-        return result
+    def iter_films_linked(self) -> Iterator[list]:
+        """Строки связанных фильмов пачками серверного курсора.
+
+        Transform собирает документ из всех строк фильма, поэтому
+        незаконченный фильм в хвосте пачки переносится в следующую.
+        """
+        films_uuid = self.films_uuid
+        if films_uuid is not None and not films_uuid:
+            return
+
+        # серверный курсор не умеет EXECUTE, но список - всё равно
+        # один параметр, и текст запроса от него не зависит
+        filtered = films_uuid is not None
+        params = (queries.uuid_array(films_uuid),) if filtered else None
+        if self.aggregated:  # строка = фильм, выравнивать нечего
+            query = queries.films_aggregated(filtered)
+            for batch in self._stream(query, params):
+                self.analyze_result(batch)
+                yield batch
+            return
+
+        query = queries.films_linked(filtered)
+        tail = []
+        for batch in self._stream(query, params):
+            batch = tail + batch
+            last_id, split = batch[-1]['fw_id'], len(batch)
+            while split > 0 and batch[split - 1]['fw_id'] == last_id:
+                split -= 1
+            tail = batch[split:]
+            if split:
+                self.analyze_result(batch[:split])
+                yield batch[:split]
+        if tail:
+            self.analyze_result(tail)
+            yield tail
+
+    def _stream(self,
+                query: str,
+                params: Optional[tuple] = None) -> Iterator[list]:
+        for batch in registry.timed(self.postgres_saver.stream(query, params),
+                                    'etl_query_seconds', stage=self.stage):
+            registry.inc('etl_rows_fetched_total', len(batch),
+                         stage=self.stage)
+            yield batch
 
     def _collect_methods(self) -> tuple:
-        return self.get_films_linked,
+        # фильмы идут потоком через iter_films_linked, кэшировать нечего:
+        # при возобновлении страница связей всё равно собирается заново
+        return ()
+
+
+class PostgresOutbox:
+    """Очередь изменённых фильмов content.film_work_outbox.
+
+    Её заполняют триггеры на всех таблицах content (миграция
+    movies_admin 0003), поэтому ловятся и изменения связей фильм-персона
+    и фильм-жанр, у которых нет поля modified. Строки читаются по
+    возрастанию id и удаляются только после загрузки их фильмов.
+    """
+    last_id: int
+
+    def __init__(self,
+                 postgres_saver: PostgresSaver,
+                 ack_saver: PostgresSaver,
+                 limit_size: int,
+                 partitions: Optional[list[int]] = None,
+                 partitions_total: int = 0) -> None:
+        self.postgres_saver = postgres_saver
+        self.ack_saver = ack_saver  # отдельное соединение: удаление + commit
+        self.limit_size = limit_size
+        # партиции воркера, при partitions_total=0 - вся очередь
+        self.partitions = partitions or []
+        self.partitions_total = partitions_total
+        self.last_id = 0
+
+    def get_batch(self) -> list:
+        """Следующая пачка очереди, ещё не отданная в этом прогоне."""
+        started = perf_counter()
+        params: tuple = (self.last_id,)
+        if self.partitions_total:
+            params += (self.partitions,)
+        result = self.postgres_saver.execute_prepared(
+            queries.outbox_batch(self.limit_size, self.partitions_total),
+            params
+        )
+        registry.observe('etl_query_seconds', perf_counter() - started,
+                         stage='outbox')
+        registry.inc('etl_rows_fetched_total', len(result), stage='outbox')
+        if result:
+            self.last_id = result[-1]['id']
+        return result
+
+    def ack(self, ids: list) -> None:
+        """Удаляет обработанные строки очереди."""
+        self.ack_saver.write(queries.outbox_ack(), (ids,))
+
+    def max_id(self) -> int:
+        return self.postgres_saver.execute_prepared(
+            queries.outbox_max_id())[0]['id']
+
+    def prune(self, max_id: int) -> None:
+        """Удаляет строки очереди до max_id включительно."""
+        self.ack_saver.write(queries.outbox_prune(), (max_id,))
+
+
+class PostgresRenames:
+    """Переименования персон и жанров страницы продюсера.
+
+    Персоне или жанру в индексе принадлежит только имя. Если оно
+    изменилось, фильмам достаточно частичного обновления (RENAME_SCRIPT
+    в elasticsearch_loader), если нет - документы не меняются вовсе.
+    Полная пересборка остаётся для тех, чьё имя ещё не известно.
+    """
+    kinds = {'person': ('person', 'full_name'), 'genre': ('genre', 'name')}
+
+    def __init__(self,
+                 postgres_saver: PostgresSaver,
+                 names: NameStore) -> None:
+        self.postgres_saver = postgres_saver
+        self.names = names
+        # новые имена запоминаются, когда фильмы загружены и курсоры
+        # сдвинуты: при сбое раньше правка просто повторится
+        self.pending = {kind: {} for kind in self.kinds}
+
+    def split(self, kind: str, ids: list[str]
+              ) -> tuple[list[str], dict[str, tuple[str, str]]]:
+        """Делит изменённые персоны или жанры страницы.
+
+        :return: id для полной пересборки
+            и переименования id -> (старое имя, новое имя)
+        """
+        if not ids:
+            return [], {}
+        table, column = self.kinds[kind]
+        current = {str(row['id']): row['name'] for row in self.postgres_saver
+                   .execute_prepared(queries.names(table, column),
+                                     (queries.uuid_array(ids),))}
+        known = self.names.get(kind, current)
+        # имя, уже исправленное на странице раньше в этом же цикле
+        known.update((id_, self.pending[kind][id_]) for id_ in current
+                     if id_ in self.pending[kind])
+        full, renamed = [], {}
+        for id_, name in current.items():
+            if id_ not in known:
+                full.append(id_)
+            elif known[id_] != name:
+                renamed[id_] = (known[id_], name)
+            else:
+                continue
+            self.pending[kind][id_] = name
+        return full, renamed
+
+    def film_patches(self,
+                     persons: dict[str, tuple[str, str]],
+                     genres: dict[str, tuple[str, str]]
+                     ) -> dict[str, dict]:
+        """Параметры RENAME_SCRIPT для каждого затронутого фильма."""
+        patches = {}
+
+        def patch(film_id) -> dict:
+            return patches.setdefault(str(film_id), {
+                'persons': {}, 'directors': {}, 'genres': {},
+            })
+
+        if persons:
+            for rows in self.postgres_saver.stream(
+                    queries.person_roles(), (queries.uuid_array(persons),)):
+                for row in rows:
+                    old, new = persons[str(row['person_id'])]
+                    if row['role'] == 'director':  # у режиссёров нет id
+                        patch(row['film_work_id'])['directors'][old] = new
+                    else:
+                        patch(row['film_work_id'])['persons'][
+                            str(row['person_id'])] = new
+        if genres:
+            for rows in self.postgres_saver.stream(
+                    queries.genre_films(), (queries.uuid_array(genres),)):
+                for row in rows:
+                    old, new = genres[str(row['genre_id'])]
+                    patch(row['film_work_id'])['genres'][old] = new
+        return patches
+
+    def take_pending(self) -> dict[str, dict[str, str]]:
+        """Отдаёт накопленные за цикл имена и начинает заново."""
+        pending = self.pending
+        self.pending = {kind: {} for kind in self.kinds}
+        return pending
+
+    def remember_pending(self, pending: dict[str, dict[str, str]]) -> None:
+        for kind, names in pending.items():
+            self.names.update(kind, names)
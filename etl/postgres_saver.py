@@ -1,11 +1,16 @@
+import hashlib
+import re
+import select
 from functools import wraps
-from time import sleep
-from typing import Optional
+from threading import Lock
+from time import monotonic, sleep
+from typing import Callable, Iterator, Optional
 
 import psycopg2
 from psycopg2.extensions import connection as _connection
 from psycopg2.extensions import cursor as _cursor
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import PoolError, ThreadedConnectionPool
 
 from config import DbConf
 from lib import get_logger
@@ -16,7 +21,8 @@ logger = get_logger('etl module')
 
 def backoff(start_sleep_time: float = 0.1,
             factor: int = 2,
-            border_sleep_time: int = 10):
+            border_sleep_time: int = 10,
+            exclude: tuple[type[Exception], ...] = ()):
     """Повторение исполнения метода.
 
     Через некоторое время, при практически любом эксепшне.
@@ -30,6 +36,7 @@ def backoff(start_sleep_time: float = 0.1,
     :param start_sleep_time: начальное время повтора
     :param factor: во сколько раз нужно увеличить время ожидания
     :param border_sleep_time: граничное время ожидания
+    :param exclude: исключения, которые не повторяются, а пробрасываются
     :return: результат выполнения функции
     """
     def func_wrapper(func):
@@ -40,6 +47,8 @@ def backoff(start_sleep_time: float = 0.1,
                 try:
                     result = func(*args, **kwargs)
                     return result
+                except exclude:
+                    raise
                 except Exception as e:
                     logger.error(
                         f'Ошибка БД. Выполнение {func.__name__}. Backoff {n}.'
@@ -53,54 +62,440 @@ def backoff(start_sleep_time: float = 0.1,
     return func_wrapper
 
 
+def positional(query: str) -> str:
+    """Плейсхолдеры %s -> $1..$n для PREPARE, %% -> %."""
+    numbers = iter(range(1, query.count('%s') + 1))
+    return re.sub(r'%[s%]', lambda match: '%' if match.group() == '%%'
+                  else f'${next(numbers)}', query)
+
+
+def get_dsl() -> dict:
+    """Параметры подключения из конфигурации."""
+    return {
+        'dbname': db_conf.name,
+        'user': db_conf.user,
+        'password': db_conf.password,
+        'host': db_conf.host,
+        'port': db_conf.port,
+    }
+
+
+class PooledConnection(_connection):
+    """Соединение пула: помнит подготовленные на нём запросы."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.prepared: set[str] = set()
+
+
+class PostgresPool:
+    """Пул соединений ETL с проверкой соединения при выдаче.
+
+    Соединения переживают прогоны и стадии: PostgresSaver берёт
+    соединение в connect и возвращает в disconnect. Закрытое
+    или не отвечающее соединение пул не выдаёт, а закрывает.
+    """
+
+    def __init__(self, dsl_dict: dict, minconn: int, maxconn: int) -> None:
+        self.pool = ThreadedConnectionPool(
+            minconn, maxconn, **dsl_dict,
+            connection_factory=PooledConnection,
+            cursor_factory=RealDictCursor,
+        )
+
+    @staticmethod
+    def healthy(connection: PooledConnection) -> bool:
+        if connection.closed:
+            return False
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            connection.rollback()
+            return True
+        except (psycopg2.Error, OSError):
+            return False
+
+    def getconn(self) -> PooledConnection:
+        while True:
+            connection = self.pool.getconn()
+            if self.healthy(connection):
+                return connection
+            self.pool.putconn(connection, close=True)
+
+    def putconn(self, connection: PooledConnection,
+                close: bool = False) -> None:
+        """Обратно в пул; незавершённую транзакцию пул откатит сам."""
+        self.pool.putconn(connection, close=close or bool(connection.closed))
+
+
+_pools: dict[tuple, PostgresPool] = {}
+_pools_lock = Lock()
+
+
+def get_pool(dsl_dict: dict) -> PostgresPool:
+    """Один пул на процесс для каждых параметров подключения."""
+    key = tuple(sorted(dsl_dict.items()))
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = PostgresPool(dsl_dict, db_conf.pool_min,
+                                       db_conf.pool_max)
+        return _pools[key]
+
+
 class PostgresSaver:
-    """Класс работы c postgresql, запись/чтение(для тестов)."""
+    """Класс работы c postgresql, запись/чтение(для тестов).
+
+    Соединение берётся из общего пула (get_pool). Если оно потеряно
+    (сеть, рестарт postgres), запрос один раз повторяется на новом;
+    прочие ошибки откатывают транзакцию, соединение остаётся рабочим.
+    """
 
     dsl_dict: dict
-    connection: _connection
+    connection: Optional[PooledConnection]
     cursor: _cursor
+    fetch_size: int
 
     def __init__(self, dsl_dict: Optional[dict] = None) -> None:
         """На вход - коннект к базе"""
 
-        self.dsl_dict = dsl_dict or {
-            'dbname': db_conf.name,
-            'user': db_conf.user,
-            'password': db_conf.password,
-            'host': db_conf.host,
-            'port': db_conf.port,
-        }
+        self.dsl_dict = dsl_dict or get_dsl()
+        self.fetch_size = db_conf.fetch_size
         self.connection, self.cursor = self.connect()
+        self._n_streams = 0  # для уникальных имён серверных курсоров
 
-    @backoff()
-    def connect(self) -> tuple[_connection, _cursor]:
-        """Устанавливаем соединение с базой"""
-        connection = psycopg2.connect(
-            **self.dsl_dict, cursor_factory=RealDictCursor,
-        )
+    @backoff(exclude=(PoolError,))
+    def connect(self) -> tuple[PooledConnection, _cursor]:
+        """Берём соединение из пула.
+
+        Исчерпанный пул (PoolError) - ошибка конфигурации DB_POOL_MAX,
+        а не сбой базы: ожидание его не освободит.
+        """
+        connection = get_pool(self.dsl_dict).getconn()
         cursor = connection.cursor()
         return connection, cursor
 
-    def execute(self, query: str) -> list:
+    def reconnect(self) -> None:
+        """Потерянное соединение пул закроет, берём другое."""
+        get_pool(self.dsl_dict).putconn(self.connection, close=True)
+        self.connection, self.cursor = self.connect()
+
+    def _retrying(self, run: Callable[[], None]) -> None:
+        try:
+            run()
+        except (psycopg2.Error, psycopg2.Warning) as exc:
+            if not self.connection.closed:
+                self.connection.rollback()
+                raise exc
+            logger.error(f'Соединение с БД потеряно. Описание:{exc}')
+            self.reconnect()
+            run()
+
+    def execute(self, query: str, params: Optional[tuple] = None) -> list:
         """Собираем выборку с базы."""
+        self._retrying(lambda: self.cursor.execute(query, params))
+        return self.cursor.fetchall()  # RealDictRow уже dict, без копии
+
+    def execute_prepared(self, query: str, params: tuple = ()) -> list:
+        """Выборка подготовленным запросом.
+
+        Первый вызов с этим текстом на соединении делает PREPARE: запрос
+        разбирается и планируется раз на соединение, дальше идёт только
+        EXECUTE с параметрами. Текст не должен зависеть от данных -
+        их место в параметрах.
+        """
+        name = f'etl_{hashlib.md5(query.encode()).hexdigest()[:16]}'
+        arguments = f'({", ".join(["%s"] * len(params))})' if params else ''
+
+        def run() -> None:
+            # после переподключения соединение новое, PREPARE заново
+            if name not in self.connection.prepared:
+                self.cursor.execute(
+                    f'PREPARE {name} AS {positional(query).rstrip(" ;")}')
+                self.connection.prepared.add(name)
+            self.cursor.execute(f'EXECUTE {name}{arguments};', params)
+
+        self._retrying(run)
+        return self.cursor.fetchall()
+
+    def write(self, query: str, params: Optional[tuple] = None) -> None:
+        """Изменяющий запрос, фиксируется сразу."""
+        def run() -> None:
+            self.cursor.execute(query, params)
+            self.connection.commit()
+
+        self._retrying(run)
+
+    def stream(self,
+               query: str,
+               params: Optional[tuple] = None,
+               batch_size: Optional[int] = None) -> Iterator[list]:
+        """Потоковая выборка через именованный (серверный) курсор.
+
+        Отдаёт строки пачками по batch_size: результат остаётся на сервере,
+        в памяти клиента одновременно не больше одной пачки.
+        """
+        batch_size = batch_size or self.fetch_size
+        self._n_streams += 1
+        cursor = self.connection.cursor(name=f'etl_stream_{self._n_streams}')
+        cursor.itersize = batch_size
         try:
-            self.cursor.execute(query)
+            cursor.execute(query, params)
+            while True:
+                batch = cursor.fetchmany(batch_size)
+                if not batch:
+                    break
+                yield batch
         except (psycopg2.Error, psycopg2.Warning) as exc:
-            self.cursor.close()
-            self.connection.close()
+            # часть строк уже отдана, повторять незаметно нельзя
+            if self.connection.closed:
+                self.reconnect()
+            else:
+                self.connection.rollback()  # закроет и серверный курсор
             raise exc
-        raw_data = self.cursor.fetchall()
-        return [dict(row) for row in raw_data]
+        finally:
+            if not cursor.closed:
+                cursor.close()
 
     def disconnect(self) -> None:
+        """Фиксируем и возвращаем соединение в пул."""
+        connection, self.connection = self.connection, None
+        if connection is None:
+            return
         self.cursor.close()
-        self.connection.commit()
-        self.connection.close()
+        if not connection.closed:
+            connection.commit()
+        get_pool(self.dsl_dict).putconn(connection)
 
     def __del__(self) -> None:
-        """Закрываем соединение, при удалении объекта."""
+        """Возвращаем соединение в пул, при удалении объекта."""
         try:
             if self.connection is not None:
                 self.disconnect()
         except Exception as e:
             pass
+
+
+class PostgresListener:
+    """Ожидание уведомлений postgres (LISTEN/NOTIFY).
+
+    Отдельное соединение в autocommit, иначе уведомления
+    не доставляются, пока открыта транзакция.
+    """
+
+    dsl_dict: dict
+    connection: _connection
+
+    def __init__(self, channel: str, dsl_dict: Optional[dict] = None) -> None:
+        self.channel = channel
+        self.dsl_dict = dsl_dict or get_dsl()
+        self.connection = self.connect()
+
+    @backoff()
+    def connect(self) -> _connection:
+        """Соединяемся и подписываемся на канал."""
+        connection = psycopg2.connect(**self.dsl_dict)
+        connection.set_session(autocommit=True)
+        with connection.cursor() as cursor:
+            cursor.execute(f'LISTEN {self.channel};')
+        return connection
+
+    def wait(self, timeout: float) -> bool:
+        """Ждёт уведомление не дольше timeout секунд.
+
+        Все накопившиеся уведомления сбрасываются разом.
+        :return: True, если было уведомление или соединение
+            пришлось восстанавливать (пока его не было,
+            уведомления могли потеряться)
+        """
+        deadline = monotonic() + timeout
+        try:
+            while True:
+                remaining = max(deadline - monotonic(), 0)
+                if select.select([self.connection], [], [], remaining) \
+                        == ([], [], []):
+                    return False
+                self.connection.poll()
+                if self.connection.notifies:
+                    self.connection.notifies.clear()
+                    return True
+        except (psycopg2.Error, OSError) as exc:
+            logger.error(f'Соединение LISTEN потеряно. Описание:{exc}')
+            self.connection.close()
+            self.connection = self.connect()
+            return True
+
+    def disconnect(self) -> None:
+        self.connection.close()
+
+
+class PartitionLeases:
+    """Аренда hash-партиций фильмов между воркерами ETL.
+
+    Партиция - сессионная advisory-блокировка (LEASE_CLASS, номер).
+    Каждый воркер держит ещё разделяемую блокировку присутствия
+    (WORKER_CLASS, 0), по ней считаются живые воркеры. Блокировки
+    живут, пока живо соединение: у упавшего воркера postgres снимает
+    их сам, и его партиции забирают остальные при следующем rebalance.
+
+    gained - партиции, полученные последним rebalance: пока они были
+    не у этого воркера, их фильмы индексировали другие.
+    """
+    LEASE_CLASS = 7001
+    WORKER_CLASS = 7002
+
+    dsl_dict: dict
+    connection: _connection
+    owned: set[int]
+    gained: set[int]
+
+    def __init__(self, total: int, dsl_dict: Optional[dict] = None) -> None:
+        self.total = total
+        self.dsl_dict = dsl_dict or get_dsl()
+        self.owned = set()
+        self.gained = set()
+        self.connection = self.connect()
+
+    @backoff()
+    def connect(self) -> _connection:
+        """Соединяемся и отмечаемся как живой воркер."""
+        connection = psycopg2.connect(**self.dsl_dict)
+        connection.set_session(autocommit=True)
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock_shared(%s, 0);',
+                           (self.WORKER_CLASS,))
+        return connection
+
+    def _workers(self, cursor: _cursor) -> int:
+        cursor.execute(
+            """SELECT count(DISTINCT pid) FROM pg_locks
+            WHERE locktype = 'advisory' AND classid = %s
+                AND objid = 0 AND granted
+                AND database = (SELECT oid FROM pg_database
+                                WHERE datname = current_database());""",
+            (self.WORKER_CLASS,)
+        )
+        return max(cursor.fetchone()[0], 1)
+
+    def _rebalance(self) -> list[int]:
+        previous = set(self.owned)
+        with self.connection.cursor() as cursor:
+            share = -(-self.total // self._workers(cursor))
+            # лишнее отдаём, чтобы новые воркеры получили свою долю
+            for partition in sorted(self.owned)[share:]:
+                cursor.execute('SELECT pg_advisory_unlock(%s, %s);',
+                               (self.LEASE_CLASS, partition))
+                self.owned.discard(partition)
+            for partition in range(self.total):
+                if len(self.owned) >= share:
+                    break
+                if partition in self.owned:
+                    continue
+                cursor.execute('SELECT pg_try_advisory_lock(%s, %s);',
+                               (self.LEASE_CLASS, partition))
+                if cursor.fetchone()[0]:
+                    self.owned.add(partition)
+        self.gained = self.owned - previous
+        return sorted(self.owned)
+
+    def rebalance(self) -> list[int]:
+        """Доводит число своих партиций до доли на живого воркера.
+
+        :return: номера партиций, которыми воркер владеет
+        """
+        try:
+            return self._rebalance()
+        except (psycopg2.Error, OSError) as exc:
+            # с соединением пропали и блокировки
+            logger.error(f'Соединение аренды потеряно. Описание:{exc}')
+            self.owned = set()
+            self.connection.close()
+            self.connection = self.connect()
+            return self._rebalance()
+
+    def alive(self) -> bool:
+        """Держатся ли ещё блокировки: живо ли соединение."""
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute('SELECT 1;')
+            return True
+        except (psycopg2.Error, OSError):
+            self.owned = set()
+            return False
+
+    def disconnect(self) -> None:
+        self.connection.close()
+
+
+class ReindexLock:
+    """Advisory-блокировка (REINDEX_CLASS, 0) между синхронизацией
+    и --full-reindex.
+
+    Прогоны синхронизации (любого движка, в том числе воркеры) держат
+    её разделяемой, переиндексация - исключительной, до переключения
+    алиаса. Блокировка живёт на отдельном соединении вне пула:
+    у упавшего процесса postgres снимает её сам. Соединение одно
+    на процесс и переживает прогоны, release только снимает блокировку.
+    """
+    REINDEX_CLASS = 7003
+
+    connection: Optional[_connection]
+    unlock: Optional[str]
+
+    def __init__(self, dsl_dict: Optional[dict] = None) -> None:
+        self.dsl_dict = dsl_dict or get_dsl()
+        self.connection = None
+        self.unlock = None  # функция снятия захваченной блокировки
+
+    @backoff()
+    def connect(self) -> _connection:
+        connection = psycopg2.connect(**self.dsl_dict)
+        connection.set_session(autocommit=True)
+        return connection
+
+    def _lock(self, function: str) -> bool:
+        """Вызов функции блокировки; разорванное соединение - заново."""
+        for attempt in (1, 2):
+            if self.connection is None or self.connection.closed:
+                self.connection = self.connect()
+            try:
+                with self.connection.cursor() as cursor:
+                    cursor.execute(f'SELECT {function}(%s, 0);',
+                                   (self.REINDEX_CLASS,))
+                    return cursor.fetchone()[0] is not False
+            except (psycopg2.Error, OSError):
+                self.disconnect()
+                if attempt == 2:
+                    raise
+
+    def acquire_shared(self) -> bool:
+        """Блокировка прогона, без ожидания.
+
+        :return: False, если идёт переиндексация
+        """
+        if self._lock('pg_try_advisory_lock_shared'):
+            self.unlock = 'pg_advisory_unlock_shared'
+            return True
+        return False
+
+    def acquire(self) -> None:
+        """Блокировка переиндексации: ждёт конца идущих прогонов."""
+        self._lock('pg_advisory_lock')
+        self.unlock = 'pg_advisory_unlock'
+
+    def release(self) -> None:
+        """Снимает захваченную блокировку, соединение остаётся."""
+        unlock, self.unlock = self.unlock, None
+        if unlock is None or self.connection is None:
+            return
+        try:
+            with self.connection.cursor() as cursor:
+                cursor.execute(f'SELECT {unlock}(%s, 0);',
+                               (self.REINDEX_CLASS,))
+        except (psycopg2.Error, OSError):
+            # с соединением пропала и блокировка
+            self.disconnect()
+
+    def disconnect(self) -> None:
+        connection, self.connection = self.connection, None
+        if connection is not None:
+            connection.close()
@@ -0,0 +1,218 @@
+"""SQL-запросы ETL.
+
+Общие для синхронного (psycopg2) и асинхронного (psycopg 3) движков,
+оба понимают плейсхолдеры %s.
+
+Списки id передаются одним параметром uuid[] (uuid_array), а не
+литералами в тексте: текст запроса не зависит от списка, поэтому
+его можно подготовить (PREPARE) и планировать раз на соединение.
+"""
+from typing import Iterable
+
+
+def uuid_array(uuids: Iterable) -> str:
+    """Значение параметра %s::uuid[] - литерал массива '{id1,id2}'.
+
+    Строка, а не list: у неё тип unknown, postgres приведёт её
+    к uuid[] и в обычном запросе, и в EXECUTE подготовленного.
+    """
+    return '{' + ','.join(map(str, uuids)) + '}'
+
+
+def changed_page(table: str, limit_size: int) -> str:
+    """Страница изменённых строк таблицы после курсора (modified, id).
+
+    Параметры: modified и id курсора.
+    """
+    return f"""
+        SELECT id, modified
+        FROM content.{table}
+        WHERE (modified, id) > (%s::timestamptz, %s::uuid)
+        ORDER BY modified, id
+        LIMIT {limit_size};"""
+
+
+def linked_films_after(link_table: str,
+                       link_column: str,
+                       limit_size: int) -> str:
+    """Страница фильмов, связанных с персонами или жанрами, после курсора.
+
+    Keyset по (modified, id), как changed_page: страница не съезжает,
+    если между запросами связи поменялись. Параметры: uuid_array
+    персон или жанров, modified и id курсора.
+    """
+    return f"""
+        SELECT DISTINCT fw.id, fw.modified
+        FROM content.film_work fw
+        JOIN content.{link_table} lfw ON lfw.film_work_id = fw.id
+        WHERE lfw.{link_column} = ANY(%s::uuid[])
+            AND (fw.modified, fw.id) > (%s::timestamptz, %s::uuid)
+        ORDER BY fw.modified, fw.id
+        LIMIT {limit_size};"""
+
+
+def columns(page_query: str) -> str:
+    """Страница (id, modified) запроса page_query одной строкой.
+
+    ids - uuid страницы по 16 байт подряд (bytea), modified - массив
+    int64 микросекунд от эпохи, в порядке строк страницы (lib.RowBatch).
+    """
+    page = page_query.strip().rstrip(';')
+    return f"""
+        SELECT
+            coalesce(string_agg(uuid_send(id), ''::bytea
+                                ORDER BY modified, id), ''::bytea) AS ids,
+            coalesce(array_agg((extract(epoch FROM modified) * 1000000)::bigint
+                               ORDER BY modified, id), '{{}}'::bigint[])
+                AS modified
+        FROM ({page}) page;"""
+
+
+def names(table: str, column: str) -> str:
+    """Текущие имена персон или жанров. Параметр: uuid_array."""
+    return f"""
+        SELECT id, {column} AS name
+        FROM content.{table}
+        WHERE id = ANY(%s::uuid[]);"""
+
+
+def person_roles() -> str:
+    """Все фильмы персон с ролью, без выборки самих фильмов.
+
+    Только роли, которые попадают в документ фильма.
+    Параметр: uuid_array персон.
+    """
+    return """
+        SELECT film_work_id, person_id, role
+        FROM content.person_film_work
+        WHERE person_id = ANY(%s::uuid[])
+            AND role IN ('actor', 'writer', 'director');"""
+
+
+def genre_films() -> str:
+    """Все фильмы жанров, без выборки самих фильмов.
+
+    Параметр: uuid_array жанров.
+    """
+    return """
+        SELECT film_work_id, genre_id
+        FROM content.genre_film_work
+        WHERE genre_id = ANY(%s::uuid[]);"""
+
+
+def films_filter(filtered: bool) -> str:
+    """Условие на id фильмов (параметр uuid_array), False - все фильмы."""
+    if not filtered:
+        return ''
+    return 'WHERE fw.id = ANY(%s::uuid[])'
+
+
+def films_linked(filtered: bool = True) -> str:
+    """Фильмы со всеми персонами и жанрами, строки фильма идут подряд."""
+    return f"""
+        SELECT
+            fw.id as fw_id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            fw.type,
+            fw.created,
+            fw.modified,
+            pfw.role,
+            p.id,
+            p.full_name,
+            g.name
+        FROM content.film_work fw
+        LEFT JOIN content.person_film_work pfw ON pfw.film_work_id = fw.id
+        LEFT JOIN content.person p ON p.id = pfw.person_id
+        LEFT JOIN content.genre_film_work gfw ON gfw.film_work_id = fw.id
+        LEFT JOIN content.genre g ON g.id = gfw.genre_id
+        {films_filter(filtered)}
+        ORDER BY fw.id;"""
+
+
+def films_aggregated(filtered: bool = True) -> str:
+    """Фильмы одной строкой: массивы персон и жанров собраны в postgres.
+
+    Персоны и жанры агрегируются в отдельных LATERAL-подзапросах,
+    поэтому декартова произведения персоны x жанры не возникает.
+    """
+    return f"""
+        SELECT
+            fw.id as fw_id,
+            fw.title,
+            fw.description,
+            fw.rating,
+            fw.type,
+            fw.created,
+            fw.modified,
+            persons.director,
+            persons.actors,
+            persons.writers,
+            genres.genre
+        FROM content.film_work fw
+        LEFT JOIN LATERAL (
+            SELECT
+                COALESCE(array_agg(DISTINCT p.full_name)
+                         FILTER (WHERE pfw.role = 'director'),
+                         '{{}}') AS director,
+                COALESCE(jsonb_agg(DISTINCT jsonb_build_object(
+                             'id', p.id, 'name', p.full_name))
+                         FILTER (WHERE pfw.role = 'actor'),
+                         '[]') AS actors,
+                COALESCE(jsonb_agg(DISTINCT jsonb_build_object(
+                             'id', p.id, 'name', p.full_name))
+                         FILTER (WHERE pfw.role = 'writer'),
+                         '[]') AS writers
+            FROM content.person_film_work pfw
+            JOIN content.person p ON p.id = pfw.person_id
+            WHERE pfw.film_work_id = fw.id
+        ) persons ON TRUE
+        LEFT JOIN LATERAL (
+            SELECT COALESCE(array_agg(DISTINCT g.name), '{{}}') AS genre
+            FROM content.genre_film_work gfw
+            JOIN content.genre g ON g.id = gfw.genre_id
+            WHERE gfw.film_work_id = fw.id
+        ) genres ON TRUE
+        {films_filter(filtered)}
+        ORDER BY fw.id;"""
+
+
+def outbox_batch(limit_size: int, partitions_total: int = 0) -> str:
+    """Пачка очереди изменённых фильмов после id.
+
+    Параметры: последний id, при partitions_total - ещё список
+    номеров партиций воркера (hash id фильма по модулю partitions_total).
+    """
+    partition_filter = ''
+    if partitions_total:
+        partition_filter = f"""
+            AND (hashtext(film_work_id::text) & 2147483647)
+                %% {partitions_total} = ANY(%s)"""
+    return f"""
+        SELECT id, film_work_id
+        FROM content.film_work_outbox
+        WHERE id > %s{partition_filter}
+        ORDER BY id
+        LIMIT {limit_size};"""
+
+
+def outbox_ack() -> str:
+    """Удаление обработанных строк очереди. Параметр: list их id."""
+    return """
+        DELETE FROM content.film_work_outbox
+        WHERE id = ANY(%s);"""
+
+
+def outbox_max_id() -> str:
+    """Последний id очереди, 0 - очередь пуста."""
+    return """
+        SELECT coalesce(max(id), 0) AS id
+        FROM content.film_work_outbox;"""
+
+
+def outbox_prune() -> str:
+    """Удаление строк очереди до id включительно. Параметр: id."""
+    return """
+        DELETE FROM content.film_work_outbox
+        WHERE id <= %s;"""
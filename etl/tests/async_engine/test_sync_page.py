@@ -0,0 +1,90 @@
+"""Фильмы одной страницы продюсера в асинхронном движке.
+
+Postgres и elasticsearch не нужны: выборки, Transform и bulk
+подменены, страницы связей режутся по курсору (modified, id).
+"""
+
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import main_async  # noqa: E402
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+LIMIT_SIZE = 2
+
+
+def film_rows(count: int) -> list[dict]:
+    rows = [{'id': uuid4(), 'modified': START + timedelta(hours=n % 2)}
+            for n in range(count)]
+    return sorted(rows, key=lambda row: (row['modified'], str(row['id'])))
+
+
+class FakeTransform:
+    """Документ - id фильма."""
+
+    def __init__(self, films_linked: list) -> None:
+        self.elastic_format = {str(row['id']): row for row in films_linked}
+
+
+class TestSyncPage(object):
+
+    @pytest.fixture(scope='function')
+    def sync(self, monkeypatch):
+        """AsyncSync, у которого персона связана с person_films.
+
+        Yields:
+            AsyncSync: bulked - id отправленных документов
+        """
+        bulked = []
+
+        async def fake_bulk(es, actions, **kwargs) -> None:
+            bulked.extend(actions)
+
+        monkeypatch.setattr(main_async, 'async_bulk', fake_bulk)
+        monkeypatch.setattr(main_async, 'transform', FakeTransform)
+        monkeypatch.setattr(main_async, 'iter_actions',
+                            lambda tr: list(tr.elastic_format))
+        monkeypatch.setattr(main_async.elastic_conf, 'skip_unchanged', False)
+
+        sync = main_async.AsyncSync(None, None, LIMIT_SIZE, 2)
+        sync.bulked = bulked
+        sync.person_films = []
+
+        async def fetch(query: str, params: tuple = None) -> list:
+            if len(params) == 3:  # страница связей после курсора
+                assert 'lfw.person_id' in query, 'no genres on the page'
+                _, modified, id_ = params
+                return [row for row in sync.person_films
+                        if (row['modified'], str(row['id'])) > (modified, id_)
+                        ][:LIMIT_SIZE]
+            return [{'id': id_, 'modified': START}
+                    for id_ in params[0].strip('{}').split(',')]
+
+        sync.fetch = fetch
+        yield sync
+
+    def test_filmwork_page(self, sync):
+        """Фильмы, изменённые напрямую, попадают в индекс."""
+        films = film_rows(3)
+        asyncio.run(sync.sync_page({'person': [], 'genre': [],
+                                    'filmwork': films}))
+
+        assert sorted(sync.bulked) == sorted(str(row['id']) for row in films)
+        assert sync.processed == 3
+
+    def test_links_keyset(self, sync):
+        """Все связанные фильмы, по одному разу, вместе с filmwork."""
+        sync.person_films = film_rows(5)
+        films = film_rows(1)
+        asyncio.run(sync.sync_page({'person': [{'id': uuid4()}],
+                                    'genre': [], 'filmwork': films}))
+
+        expected = [str(row['id']) for row in sync.person_films + films]
+        assert sorted(sync.bulked) == sorted(expected)
@@ -0,0 +1,94 @@
+"""Документы, которые elasticsearch отклонил, в режиме ndjson.
+
+Вместо elasticsearch - клиент, который отвечает на bulk
+заданными статусами по id документа.
+"""
+
+import sys
+from pathlib import Path
+
+import pytest
+from elasticsearch import helpers
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import elasticsearch_loader  # noqa: E402
+from lib import State, get_storage  # noqa: E402
+
+
+class FakeElasticsearch:
+    """bulk: статус документа из statuses, по умолчанию 201."""
+
+    def __init__(self, statuses: dict[str, int]) -> None:
+        self.statuses = statuses
+
+    def bulk(self, operations: list[bytes]) -> dict:
+        items = []
+        for action in operations[::2]:
+            id_ = action.split(b'"_id":"')[1].split(b'"')[0].decode()
+            status = self.statuses.get(id_, 201)
+            item = {'_id': id_, 'status': status}
+            if status >= 300:
+                item['error'] = {'type': 'mapper_parsing_exception'}
+            items.append({'index': item})
+        return {'items': items}
+
+
+class FakeTransform:
+
+    def __init__(self, ids: list[str]) -> None:
+        self.ids = ids
+
+    def documents(self) -> dict[str, bytes]:
+        return {id_: b'{"id":"%s"}' % id_.encode() for id_ in self.ids}
+
+
+class TestDeadLetter(object):
+
+    @pytest.fixture(scope='function')
+    def make_loader(self, tmp_path, monkeypatch):
+        """Загрузчик ndjson без дайджестов и без пауз между повторами.
+
+        Yields:
+            Callable: statuses -> ElasticsearchLoader
+        """
+        monkeypatch.setattr(elasticsearch_loader.cache_conf, 'dead_letter',
+                            str(tmp_path / 'dead_letter.txt'))
+        monkeypatch.setattr(elasticsearch_loader.elastic_conf,
+                            'skip_unchanged', False)
+        monkeypatch.setattr(elasticsearch_loader, 'retry_pause',
+                            lambda attempt: 0)
+
+        def make_loader(statuses: dict[str, int]):
+            loader = elasticsearch_loader.ElasticsearchLoader(
+                es=FakeElasticsearch(statuses),
+            )
+            loader.bulk_mode = 'ndjson'
+            return loader
+
+        yield make_loader
+
+    @staticmethod
+    def dead_letters() -> dict:
+        storage = get_storage(elasticsearch_loader.cache_conf.dead_letter)
+        return State(storage).get_state('documents') or {}
+
+    def test_permanent_error_is_dead_lettered(self, make_loader):
+        """400 не прерывает пачку, документ сохраняется для разбора."""
+        loader = make_loader({'b': 400})
+
+        assert loader.load_it(FakeTransform(['a', 'b', 'c'])) == 2
+        assert list(self.dead_letters()) == ['b']
+        assert self.dead_letters()['b']['status'] == 400
+
+        # документ исправлен и принят - из списка он уходит
+        assert make_loader({}).load_it(FakeTransform(['b'])) == 1
+        assert self.dead_letters() == {}
+
+    def test_transient_error_aborts(self, make_loader):
+        """429 после всех повторов прерывает прогон."""
+        loader = make_loader({'b': 429})
+
+        with pytest.raises(helpers.BulkIndexError):
+            loader.load_it(FakeTransform(['a', 'b']))
+        assert self.dead_letters() == {}
@@ -0,0 +1,97 @@
+"""Множество затронутых фильмов между циклами в режиме MAIN_PIPELINED.
+
+Конец цикла фиксируется в потоке загрузки, когда поток извлечения
+уже сохранил множество следующего цикла. Postgres и elasticsearch
+не нужны: сбор множества и сборка фильмов подменены.
+"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import monotonic, sleep
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import main  # noqa: E402
+from lib import State, get_storage  # noqa: E402
+from pipeline import Pipeline  # noqa: E402
+from postgres_operations import Cursor, PostgresProducer  # noqa: E402
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+WAIT_TIMEOUT = 5  # секунд на то, чтобы извлечение ушло в следующий цикл
+
+
+def cursors_at(hours: int) -> dict:
+    return {stream: Cursor(modified=START + timedelta(hours=hours))
+            for stream in PostgresProducer.streams}
+
+
+class FakeMerger:
+    """Сборка фильмов: пачка - сами id куска."""
+
+    def __init__(self, postgres_saver, modified_after, ids,
+                 aggregated=False) -> None:
+        self.ids = list(ids)
+        self.max_modified_after = START
+
+    def iter_films_linked(self):
+        yield self.ids
+
+
+class TestPipelinedCycles(object):
+
+    @pytest.fixture(scope='function')
+    def extractor(self, tmp_path, monkeypatch):
+        """Extractor на два цикла по три фильма.
+
+        Yields:
+            Extractor
+        """
+        monkeypatch.setattr(main.cache_conf, 'dirty',
+                            str(tmp_path / 'dirty.txt'))
+        monkeypatch.setattr(main, 'PostgresMerger', FakeMerger)
+        extractor = main.Extractor(None, 2, START, cursors_at(0))
+        cycles = iter([
+            (sorted(str(uuid4()) for _ in range(3)), cursors_at(1), False),
+            (sorted(str(uuid4()) for _ in range(3)), cursors_at(2), True),
+        ])
+        monkeypatch.setattr(extractor, 'collect_dirty',
+                            lambda cursors: next(cycles))
+        yield extractor
+
+    @staticmethod
+    def saved(extractor) -> State:
+        return State(get_storage(main.cache_conf.dirty))
+
+    def wait_for_cycle(self, extractor, cursors: dict) -> None:
+        """Ждём, пока извлечение сохранит множество цикла с cursors."""
+        deadline = monotonic() + WAIT_TIMEOUT
+        while self.saved(extractor).get_state('from') != cursors:
+            assert monotonic() < deadline, 'next cycle was not saved'
+            sleep(0.01)
+
+    def test_finish_keeps_next_cycle(self, extractor):
+        """Конец первого цикла не стирает уже сохранённый второй."""
+        second_from = main.dump_cursors(cursors_at(1))
+
+        def commit(checkpoint) -> None:
+            if checkpoint.callback is None:
+                return
+            first_cycle = checkpoint.values['cursors'] == second_from
+            if first_cycle:
+                self.wait_for_cycle(extractor, second_from)
+            checkpoint.callback()
+            if first_cycle:
+                saved = self.saved(extractor)
+                assert saved.get_state('from') == second_from
+                assert saved.get_state('ids') is not None
+                assert saved.get_state('cursors') is not None
+
+        pipeline = Pipeline((lambda films: films, len), commit)
+
+        assert pipeline.run_pipelined(extractor) == 6
+        # конец второго цикла стирает уже его собственное множество
+        assert self.saved(extractor).get_state('from') is None
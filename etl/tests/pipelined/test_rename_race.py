@@ -0,0 +1,111 @@
+"""Частичная правка имени и полный документ, ещё стоящий в очереди.
+
+В режиме MAIN_PIPELINED извлечение следующего цикла идёт, пока
+загружаются пачки прошлого. Правка переименования должна лечь
+в индекс после них, иначе документ с прежним именем её перезапишет.
+Postgres и elasticsearch не нужны: сбор множества, сборка фильмов
+и загрузчик подменены.
+"""
+
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from time import sleep
+from uuid import uuid4
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+import main  # noqa: E402
+from pipeline import Pipeline  # noqa: E402
+from postgres_operations import Cursor, PostgresProducer  # noqa: E402
+
+START = datetime(2023, 1, 1, tzinfo=timezone.utc)
+LOAD_SECONDS = 0.2  # пачка загружается дольше, чем собирается цикл
+
+
+def cursors_at(hours: int) -> dict:
+    return {stream: Cursor(modified=START + timedelta(hours=hours))
+            for stream in PostgresProducer.streams}
+
+
+class FakeMerger:
+    """Сборка фильмов: пачка - сами id куска."""
+
+    def __init__(self, postgres_saver, modified_after, ids,
+                 aggregated=False) -> None:
+        self.ids = list(ids)
+        self.max_modified_after = START
+
+    def iter_films_linked(self):
+        yield self.ids
+
+
+class FakeLoader:
+    """Частичные обновления пишутся в общий журнал загрузки."""
+
+    def __init__(self, events: list) -> None:
+        self.events = events
+
+    def patch_names(self, patches: dict) -> list[str]:
+        self.events.append(('patch', sorted(patches)))
+        return []
+
+
+class TestRenameRace(object):
+
+    @pytest.fixture(scope='function')
+    def film_id(self) -> str:
+        return str(uuid4())
+
+    @pytest.fixture(scope='function')
+    def events(self) -> list:
+        return []
+
+    @pytest.fixture(scope='function')
+    def extractor(self, tmp_path, monkeypatch, film_id, events):
+        """Два цикла: фильм целиком, затем переименование в нём.
+
+        Yields:
+            Extractor
+        """
+        monkeypatch.setattr(main.cache_conf, 'dirty',
+                            str(tmp_path / 'dirty.txt'))
+        monkeypatch.setattr(main.cache_conf, 'names',
+                            str(tmp_path / 'names.sqlite'))
+        monkeypatch.setattr(main, 'PostgresMerger', FakeMerger)
+        extractor = main.Extractor(None, 2, START, cursors_at(0),
+                                   loader=FakeLoader(events))
+
+        def second_cycle(cursors: dict) -> tuple:
+            extractor.patches.append({film_id: {
+                'persons': {}, 'directors': {}, 'genres': {'a': 'b'},
+            }})
+            return [str(uuid4())], cursors_at(2), True
+
+        cycles = iter([
+            lambda cursors: ([film_id], cursors_at(1), False),
+            second_cycle,
+        ])
+        monkeypatch.setattr(extractor, 'collect_dirty',
+                            lambda cursors: next(cycles)(cursors))
+        yield extractor
+
+    def test_patch_after_queued_document(self, extractor, film_id, events):
+        """Правка уходит после загрузки документа прошлого цикла."""
+
+        def load(films: list) -> int:
+            sleep(LOAD_SECONDS)
+            events.append(('load', films))
+            return len(films)
+
+        def commit(checkpoint) -> None:
+            if checkpoint.callback is not None:
+                checkpoint.callback()
+
+        pipeline = Pipeline((lambda films: films, load), commit)
+
+        assert pipeline.run_pipelined(extractor) == 2
+        assert events.index(('load', [film_id])) \
+            < events.index(('patch', [film_id]))
@@ -1,7 +1,9 @@
+import random
 from datetime import datetime
 from typing import Optional
 from uuid import UUID, uuid4
 
+import orjson
 from pydantic import BaseModel, Field
 
 
@@ -24,6 +26,21 @@ class DbFilmPerson(BaseModel):
     type: str
 
 
+class DbFilmAggregated(BaseModel):
+    """Строка фильма с массивами, собранными в postgres."""
+    fw_id: UUID = Field(default_factory=uuid4)
+    created: datetime
+    description: Optional[str]
+    modified: datetime
+    rating: Optional[float]
+    title: str
+    type: str
+    genre: list[str]
+    director: list[str]
+    actors: list[ActorsWriters]
+    writers: list[ActorsWriters]
+
+
 class EsFilm(BaseModel):
     """
     схема ElasticSearch нужные данные:
@@ -96,15 +113,153 @@ class Transform:
                     (one_db_film.id, one_db_film.full_name)
                 )
         # второй этап. укладываем данные ближе к формату эластик.
+        # множества сортируются: одинаковый фильм - одинаковый документ,
+        # иначе дайджест документа менялся бы от запуска к запуску
         self.elastic_format = {}
         for fw_id, film_dict in step_one.items():
+            film_dict['genre'] = sorted(film_dict['genre'], key=str)
+            film_dict['director'] = sorted(film_dict['director'], key=str)
             film_dict['actors'] = [{'id': uuid, 'name': name} for uuid, name
-                                   in film_dict['actors']]
+                                   in sorted(film_dict['actors'], key=str)]
             film_dict['writers'] = [{'id': uuid, 'name': name} for uuid, name
-                                    in film_dict['writers']]
+                                    in sorted(film_dict['writers'], key=str)]
             film_dict['actors_names'] = list(map(lambda x: x['name'],
                                                  film_dict['actors']))
             film_dict['writers_names'] = list(map(lambda x: x['name'],
                                                   film_dict['writers']))
             film_dict['id'] = fw_id
             self.elastic_format[fw_id] = EsFilm.model_validate(film_dict)
+
+    def documents(self) -> dict[str, bytes]:
+        """JSON документов для bulk: id фильма -> байты UTF-8."""
+        return {str(filmwork_id): es_film.model_dump_json().encode()
+                for filmwork_id, es_film in self.elastic_format.items()}
+
+
+class AggregatedTransform(Transform):
+    """Transform для режима агрегации в postgres: одна строка на фильм.
+
+    Дедупликация уже сделана запросом, остаётся переложить поля.
+    """
+    films_linked: list[DbFilmAggregated]
+
+    def __init__(self, films_linked: list[dict]) -> None:
+        self.raw_films_linked = films_linked
+        self.films_linked = [DbFilmAggregated.model_validate(film_dict)
+                             for film_dict in films_linked]
+
+    def reformat(self) -> None:
+        self.elastic_format = {}
+        for film in self.films_linked:
+            self.elastic_format[film.fw_id] = EsFilm(
+                id=film.fw_id,
+                imdb_rating=film.rating,
+                genre=film.genre,
+                title=film.title,
+                description=film.description,
+                director=film.director,
+                actors_names=[actor.name for actor in film.actors],
+                writers_names=[writer.name for writer in film.writers],
+                actors=film.actors,
+                writers=film.writers,
+            )
+
+
+class _Film:
+    """Накопитель строк одного фильма для FastTransform."""
+    __slots__ = ('rating', 'title', 'description',
+                 'genre', 'director', 'actors', 'writers')
+
+    def __init__(self) -> None:
+        self.genre, self.director = set(), set()
+        self.actors, self.writers = set(), set()
+
+
+def _persons(pairs: set) -> list[dict]:
+    # порядок как у Transform: по id, id уникален
+    return [{'id': str(id_), 'name': name}
+            for id_, name in sorted(pairs, key=lambda x: str(x[0]))]
+
+
+class FastTransform(Transform):
+    """Transform без pydantic на каждой строке.
+
+    Строки join читаются как есть, фильм копится в _Film со __slots__,
+    документ сразу собирается словарём с полями EsFilm в том же
+    порядке, поэтому JSON совпадает с Transform байт в байт.
+    Через EsFilm проверяется только доля документов validate_sample
+    (1 - все, для отладки).
+    """
+    elastic_format: dict[str, dict]
+
+    def __init__(self,
+                 films_linked: list[dict],
+                 validate_sample: float = 0.0) -> None:
+        self.raw_films_linked = films_linked
+        self.validate_sample = validate_sample
+
+    def reformat(self) -> None:
+        films: dict[str, _Film] = {}
+        for row in self.raw_films_linked:
+            film = films.get(row['fw_id'])
+            if film is None:
+                film = films[row['fw_id']] = _Film()
+            film.rating = row['rating']
+            film.title = row['title']
+            film.description = row['description']
+            film.genre.add(row['name'])
+            role = row['role']
+            if role == 'director':
+                film.director.add(row['full_name'])
+            elif role == 'actor':
+                film.actors.add((row['id'], row['full_name']))
+            elif role == 'writer':
+                film.writers.add((row['id'], row['full_name']))
+
+        self.elastic_format = {}
+        for fw_id, film in films.items():
+            actors, writers = _persons(film.actors), _persons(film.writers)
+            self.elastic_format[str(fw_id)] = self._document(
+                fw_id, film.rating, sorted(film.genre, key=str), film.title,
+                film.description, sorted(film.director, key=str),
+                actors, writers,
+            )
+
+    def _document(self, fw_id, rating, genre, title, description,
+                  director, actors, writers) -> dict:
+        document = {
+            'id': str(fw_id),
+            'imdb_rating': None if rating is None else float(rating),
+            'genre': genre,
+            'title': title,
+            'description': description,
+            'director': director,
+            'actors_names': [actor['name'] for actor in actors],
+            'writers_names': [writer['name'] for writer in writers],
+            'actors': actors,
+            'writers': writers,
+        }
+        if self.validate_sample and random.random() < self.validate_sample:
+            EsFilm.model_validate(document)
+        return document
+
+    def documents(self) -> dict[str, bytes]:
+        # orjson сразу отдаёт компактные байты, uuid и float - сам
+        return {filmwork_id: orjson.dumps(document)
+                for filmwork_id, document in self.elastic_format.items()}
+
+
+class FastAggregatedTransform(FastTransform):
+    """FastTransform для режима агрегации в postgres."""
+
+    def reformat(self) -> None:
+        self.elastic_format = {}
+        for row in self.raw_films_linked:
+            actors = [{'id': str(actor['id']), 'name': actor['name']}
+                      for actor in row['actors']]
+            writers = [{'id': str(writer['id']), 'name': writer['name']}
+                       for writer in row['writers']]
+            self.elastic_format[str(row['fw_id'])] = self._document(
+                row['fw_id'], row['rating'], row['genre'], row['title'],
+                row['description'], row['director'], actors, writers,
+            )